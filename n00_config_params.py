@@ -164,6 +164,10 @@ path_prep = os.path.join(path_general, 'Analyses', 'preprocessing')
 path_precompute = os.path.join(path_general, 'Analyses', 'precompute') 
 path_results = os.path.join(path_general, 'Analyses', 'results') 
 path_slurm = os.path.join(path_general, 'Script_slurm')
+path_wavelets_cache = os.path.join(path_precompute, 'wavelets_cache')
+path_stats_cache = os.path.join(path_precompute, 'stats_cache')
+stats_cache_max_size = 500e6 # bytes, oldest used results evicted first
+stats_cache_evict_every = 20 # cache writes by process between two eviction scans
 
 #### slurm params
 mem_crnl_cluster = '10G'
@@ -258,6 +262,30 @@ PPI_lm_time = [-2.5, 0]
 allplot_erp_ylim = (-0.3, 0.3)
 
 ERP_n_surrogate = 1000
+perm_mem_budget = 256e6 # bytes of surrogates gathered at once in permutation stats
+
+
+
+
+
+
+
+################################
+######## TF PARAMS ########
+################################
+
+
+#### globals read by get_wavelets / get_wavelets_fc, freq_list and ncycle_list follow the < 45 Hz band of get_wavelets_fc
+freq_list = [1, 45] #Hz
+nfrex = 150
+ncycle_list = [7, 12]
+wavetime = np.arange(-3, 3, 1/srate)
+frex = np.logspace(np.log10(freq_list[0]), np.log10(freq_list[1]), nfrex)
+cycles = np.logspace(np.log10(ncycle_list[0]), np.log10(ncycle_list[1]), nfrex).astype('int')
+
+nfrex_fc = 50
+
+tf_mem_budget = 512e6 # bytes of (frex, nfft) temporaries across threads in compute_tf_fft
 
 
 
@@ -4,18 +4,26 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.signal
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.fft
+import scipy.ndimage
+import scipy.stats
 import mne
 import pandas as pd
 import sys
 import stat
+import hashlib
 import subprocess
 import xarray as xr
 import physio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from bycycle.cyclepoints import find_extrema
 import neurokit2 as nk
 
 from n00_config_params import *
+from n00quater_robust_stats import *
 
 
 debug = False
@@ -465,20 +473,24 @@ def execute_function_in_slurm_bash_mem_choice(name_script, name_function, params
 ################################
 
 
-def get_wavelets():
+#frex, ncycle_list, wavetime = frex, cycles, wavetime
+def compute_morlet_wavelets(frex, ncycle_list, wavetime):
 
-    #### compute wavelets
-    wavelets = np.zeros((nfrex, len(wavetime)), dtype=complex)
+    # create Morlet wavelet family, all frex at once (frex, wavetime)
+    frex = np.asarray(frex).reshape(-1,1)
+    s = np.asarray(ncycle_list).reshape(-1,1) / (2*np.pi*frex)
+    gw = np.exp(-wavetime**2/ (2*s**2)) 
+    sw = np.exp(1j*(2*np.pi*frex*wavetime))
+    wavelets = gw * sw
 
-    # create Morlet wavelet family
-    for fi in range(nfrex):
-        
-        s = cycles[fi] / (2*np.pi*frex[fi])
-        gw = np.exp(-wavetime**2/ (2*s**2)) 
-        sw = np.exp(1j*(2*np.pi*frex[fi]*wavetime))
-        mw =  gw * sw
+    return wavelets
+
+
+
+def get_wavelets():
 
-        wavelets[fi,:] = mw
+    #### compute wavelets
+    wavelets = compute_morlet_wavelets(frex, cycles, wavetime)
 
     if debug:
 
@@ -496,6 +508,106 @@ def get_wavelets():
 
 
 
+#name, compute_fun = f'wavelets_{key}', lambda: compute_morlet_wavelets(frex, ncycle_list, wavetime)
+def load_or_compute_wavelets_cache(name, compute_fun):
+    """
+    Return path_wavelets_cache/{name}.npy memory-mapped, computing and saving it first if missing.
+    Save is atomic (tmp file then os.replace) so concurrent slurm jobs never read a partial file.
+    """
+
+    os.makedirs(path_wavelets_cache, exist_ok=True)
+    cache_file = os.path.join(path_wavelets_cache, f'{name}.npy')
+
+    if not os.path.exists(cache_file):
+        cache_file_tmp = os.path.join(path_wavelets_cache, f'{name}_{os.getpid()}_tmp.npy')
+        np.save(cache_file_tmp, compute_fun())
+        os.replace(cache_file_tmp, cache_file)
+
+    return np.load(cache_file, mmap_mode='r')
+
+
+
+#frex, ncycle_list, wavetime = frex, cycles, wavetime
+def get_wavelets_cached(frex, ncycle_list, wavetime):
+    """
+    Morlet bank content-addressed by (frex, ncycle_list, wavetime), wavetime carrying srate.
+    """
+
+    key = hashlib.sha1(b''.join(np.ascontiguousarray(arr, dtype='float64').tobytes() for arr in [frex, ncycle_list, wavetime])).hexdigest()[:16]
+
+    return load_or_compute_wavelets_cache(f'wavelets_{key}', lambda: compute_morlet_wavelets(frex, ncycle_list, wavetime))
+
+
+
+#n_times, n_wave = data.shape[-1], wavelets.shape[-1]
+def get_tf_nfft(n_times, n_wave):
+
+    return scipy.fft.next_fast_len(n_times + n_wave - 1)
+
+
+
+#data, wavelets = data[:len(chan_list_eeg),:], get_wavelets()
+def compute_tf_fft(data, wavelets, output='power', n_jobs=n_core, n_freq_chunk=None, wavelets_fft=None):
+    """
+    Morlet convolution of every chan with the whole wavelet bank in the frequency domain.
+    Each chan FFT is computed once (padded to scipy.fft.next_fast_len) and multiplied by the bank FFT,
+    the bank FFT is computed by chunk of frex and never held whole (one (frex, nfft) bank by recording length).
+    chan are parallelized in a thread pool (scipy.fft releases the GIL).
+    Output 'power' : float32 (chan, frex, time), 'complex' : complex64 (chan, frex, time), same alignment as fftconvolve 'same'.
+    n_freq_chunk bounds the (frex, nfft) temporaries, None : set from tf_mem_budget.
+    wavelets_fft : bank FFT already padded to get_tf_nfft(n_times, n_wave), for callers convolving many signals of one length.
+    """
+
+    data = np.atleast_2d(data)
+    n_chan, n_times = data.shape
+    n_frex, n_wave = wavelets.shape
+    n_workers = min(n_jobs, n_chan)
+
+    nfft = get_tf_nfft(n_times, n_wave)
+    half_wave = (n_wave - 1) // 2
+
+    if wavelets_fft is not None and wavelets_fft.shape != (n_frex, nfft):
+        raise ValueError(f'wavelets_fft must be of shape {(n_frex, nfft)}, not {wavelets_fft.shape}')
+
+    #### complex64 (freq, nfft) temporaries : the bank chunk FFT, then about 3 by thread (product, ifft, power)
+    if n_freq_chunk is None:
+        n_freq_chunk = int(np.clip(tf_mem_budget // (8 * nfft * (3 * n_workers + 1)), 1, n_frex))
+
+    if output == 'power':
+        tf = np.zeros((n_chan, n_frex, n_times), dtype='float32')
+    elif output == 'complex':
+        tf = np.zeros((n_chan, n_frex, n_times), dtype='complex64')
+    else:
+        raise ValueError(f"output must be 'power' or 'complex', not {output}")
+
+    data_fft = scipy.fft.fft(data.astype('float32'), n=nfft, axis=-1, workers=n_jobs)
+
+    def convolve_chan(chan_i, freq_sel, wavelets_fft):
+
+        conv = scipy.fft.ifft(wavelets_fft * data_fft[chan_i], axis=-1)[:, half_wave:half_wave + n_times]
+
+        if output == 'power':
+            tf[chan_i, freq_sel] = conv.real**2 + conv.imag**2
+        else:
+            tf[chan_i, freq_sel] = conv
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+
+        for freq_start in range(0, n_frex, n_freq_chunk):
+
+            freq_sel = slice(freq_start, freq_start + n_freq_chunk)
+            if wavelets_fft is None:
+                wavelets_fft_chunk = scipy.fft.fft(np.asarray(wavelets[freq_sel], dtype='complex64'), n=nfft, axis=-1, workers=n_jobs)
+            else:
+                wavelets_fft_chunk = wavelets_fft[freq_sel]
+
+            list(executor.map(lambda chan_i: convolve_chan(chan_i, freq_sel, wavelets_fft_chunk), range(n_chan)))
+
+    return tf
+
+
+
+
 def get_wavelets_fc(band_prep, freq):
 
     #### select wavelet parameters
@@ -509,19 +621,9 @@ def get_wavelets_fc(band_prep, freq):
         nfrex = nfrex_fc
         ncycle_list = np.linspace(20, 41, nfrex)
 
-    #### compute wavelets
+    #### compute wavelets, or memmap them from the cache
     frex  = np.linspace(freq[0],freq[1],nfrex)
-    wavelets = np.zeros((nfrex,len(wavetime)) ,dtype=complex)
-
-    # create Morlet wavelet family
-    for fi in range(0,nfrex):
-        
-        s = ncycle_list[fi] / (2*np.pi*frex[fi])
-        gw = np.exp(-wavetime**2/ (2*s**2)) 
-        sw = np.exp(1j*(2*np.pi*frex[fi]*wavetime))
-        mw =  gw * sw
-
-        wavelets[fi,:] = mw
+    wavelets = get_wavelets_cached(frex, ncycle_list, wavetime)
 
     return wavelets
 
@@ -790,38 +892,121 @@ def get_all_respi_ratio(sujet):
 ################################
 
 
-#resp_features, data = respfeatures_allcond[cond][odor_i], tf[n_chan,0,:]
-def stretch_data(resp_features, nb_point_by_cycle, data, srate):
+stretch_operator_cache = {}
+
+
+#resp_features, nb_point_by_cycle, n_times, srate = respfeatures_allcond[cond][odor_i], stretch_point_TF, tf.shape[-1], srate
+def get_stretch_operator(resp_features, nb_point_by_cycle, n_times, srate):
+    """
+    Sparse linear interpolation operator doing the same warp as physio.deform_traces_to_cycle_template.
+    Shape (n_cycle_select*nb_point_by_cycle, n_times), only cycles with select == 1 are kept.
+    Cached by (cycle_times, select, nb_point_by_cycle, ratio, n_times, srate) so every chan and freq reuse it.
+    """
 
     #### params
     cycle_times = resp_features[['inspi_time', 'expi_time', 'next_inspi_time']].values
     mean_cycle_duration = np.mean(resp_features[['inspi_duration', 'expi_duration']].values, axis=0)
     mean_inspi_ratio = mean_cycle_duration[0]/mean_cycle_duration.sum()
-    times = np.arange(0,data.shape[0])/srate
+    mask = resp_features[resp_features['select'] == 1].index.values
 
-    #### stretch
     if stretch_TF_auto:
-
-        cycles = physio.deform_traces_to_cycle_template(data.reshape(-1,1), times, cycle_times, points_per_cycle=nb_point_by_cycle, 
-                segment_ratios=mean_inspi_ratio, output_mode='stacked')
+        ratio = mean_inspi_ratio
     else:
-        
-        cycles = physio.deform_traces_to_cycle_template(data.reshape(-1,1), times, cycle_times, points_per_cycle=nb_point_by_cycle, 
-                segment_ratios=ratio_stretch_TF, output_mode='stacked')
+        ratio = ratio_stretch_TF
 
-    #### clean
-    mask = resp_features[resp_features['select'] == 1].index.values
-    cycle_clean = cycles[mask, :, :]
+    key = (cycle_times.tobytes(), mask.tobytes(), nb_point_by_cycle, float(ratio), n_times, srate)
+
+    if key in stretch_operator_cache:
+        return stretch_operator_cache[key], mean_inspi_ratio
+
+    #### times to cycles, clipped to cycle_times range
+    times = np.arange(0, n_times)/srate
+    keep_times, = np.nonzero((times >= cycle_times[0, 0]) & (times < cycle_times[-1, -1]))
+    clipped_times = times[keep_times]
+
+    cycle_i = np.searchsorted(cycle_times[:, 0], clipped_times, side='right') - 1
+    t_inspi, t_expi, t_next = cycle_times[cycle_i, 0], cycle_times[cycle_i, 1], cycle_times[cycle_i, 2]
+    times_to_cycles = np.where(clipped_times < t_expi, 
+                               (clipped_times - t_inspi) / (t_expi - t_inspi) * ratio + cycle_i, 
+                               (clipped_times - t_expi) / (t_next - t_expi) * (1 - ratio) + cycle_i + ratio)
+
+    #### linear interpolation weights on cycle points, extrapolate on edges as interp1d
+    cycle_points = np.arange(0, cycle_times.shape[0], 1. / nb_point_by_cycle).reshape(cycle_times.shape[0], nb_point_by_cycle)[mask].reshape(-1)
+    hi = np.clip(np.searchsorted(times_to_cycles, cycle_points), 1, times_to_cycles.size - 1)
+    lo = hi - 1
+    w_hi = (cycle_points - times_to_cycles[lo]) / (times_to_cycles[hi] - times_to_cycles[lo])
+
+    rows = np.repeat(np.arange(cycle_points.size), 2)
+    cols = keep_times[np.stack((lo, hi), axis=1).reshape(-1)]
+    weights = np.stack((1 - w_hi, w_hi), axis=1).reshape(-1)
+    stretch_operator = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(cycle_points.size, n_times))
+
+    if len(stretch_operator_cache) >= 32:
+        stretch_operator_cache.clear()
+    stretch_operator_cache[key] = stretch_operator
+
+    return stretch_operator, mean_inspi_ratio
 
-    #### reshape
-    if np.iscomplex(data[0]):
-        data_stretch = np.zeros(( cycle_clean.shape[0], nb_point_by_cycle ), dtype='complex')
+
+
+#resp_features, nb_point_by_cycle, data, srate = respfeatures_allcond[cond][odor_i], stretch_point_TF, tf, srate
+def stretch_data_tf_allchan(resp_features, nb_point_by_cycle, data, srate, n_chan_chunk=4, memmap_name=None):
+    """
+    Stretch data of shape (chan, freq, time) with one sparse matmul by chunk of chan and block of cycles,
+    blocks sized from tf_mem_budget so only the output is as large as the whole stretch.
+    Returns data_stretch of shape (cycle, chan, freq, point).
+    If memmap_name is given, data_stretch is a complex64/float32 memmap in path_memmap (remove it after use).
+    """
+
+    stretch_operator, mean_inspi_ratio = get_stretch_operator(resp_features, nb_point_by_cycle, data.shape[-1], srate)
+    n_cycles = stretch_operator.shape[0] // nb_point_by_cycle
+    n_chan, n_freq = data.shape[0], data.shape[1]
+    shape_stretch = ( n_cycles, n_chan, n_freq, nb_point_by_cycle )
+
+    if memmap_name is not None:
+        dtype_stretch = 'complex64' if np.iscomplexobj(data) else 'float32'
+        data_stretch = np.memmap(os.path.join(path_memmap, memmap_name), dtype=dtype_stretch, mode='w+', shape=shape_stretch)
+    elif np.iscomplexobj(data):
+        data_stretch = np.zeros(shape_stretch, dtype='complex')
     else:
-        data_stretch = np.zeros(( cycle_clean.shape[0], nb_point_by_cycle ))
+        data_stretch = np.zeros(shape_stretch)
+
+    #### (cycle*point, time) @ (time, chan*freq) on operator rows of a cycle block, written in place in the (cycle, chan, freq, point) output
+    # complex128 / float64 product and its transposed copy by block
+    n_chan_sel_max = min(n_chan_chunk, n_chan)
+    n_cycle_block = int(max(tf_mem_budget // (2 * 16 * n_chan_sel_max * n_freq * nb_point_by_cycle), 1))
+
+    for chan_start in range(0, n_chan, n_chan_chunk):
 
-    for cycle_i in range(cycle_clean.shape[0]):
+        chan_sel = slice(chan_start, min(chan_start + n_chan_chunk, n_chan))
+        data_chunk = data[chan_sel].reshape(-1, data.shape[-1])
+        n_chan_sel = data_chunk.shape[0] // n_freq
 
-        data_stretch[cycle_i, :] = cycle_clean[cycle_i,:].reshape(-1)
+        for cycle_start in range(0, n_cycles, n_cycle_block):
+
+            cycle_stop = min(cycle_start + n_cycle_block, n_cycles)
+            stretch_block = stretch_operator[cycle_start*nb_point_by_cycle:cycle_stop*nb_point_by_cycle] @ data_chunk.T
+            data_stretch[cycle_start:cycle_stop, chan_sel] = stretch_block.reshape(cycle_stop - cycle_start, nb_point_by_cycle, n_chan_sel, n_freq).transpose(0, 2, 3, 1)
+
+    if memmap_name is not None:
+        data_stretch.flush()
+
+    #### inspect
+    if debug == True:
+
+        plt.pcolormesh(np.mean(data_stretch[:, 0], axis=0))
+        plt.show()
+
+    return data_stretch, mean_inspi_ratio
+
+
+
+#resp_features, data = respfeatures_allcond[cond][odor_i], tf[n_chan,0,:]
+def stretch_data(resp_features, nb_point_by_cycle, data, srate):
+
+    #### stretch
+    data_stretch, mean_inspi_ratio = stretch_data_tf_allchan(resp_features, nb_point_by_cycle, data.reshape(1, 1, -1), srate)
+    data_stretch = data_stretch[:, 0, 0, :]
 
     #### inspect
     if debug == True:
@@ -837,45 +1022,96 @@ def stretch_data(resp_features, nb_point_by_cycle, data, srate):
 
 
 #resp_features, nb_point_by_cycle, data, srate = respfeatures_allcond[cond][odor_i], stretch_point_TF, tf[n_chan,:,:], srate
-def stretch_data_tf(resp_features, nb_point_by_cycle, data, srate):
-
-    #### params
-    cycle_times = resp_features[['inspi_time', 'expi_time', 'next_inspi_time']].values
-    mean_cycle_duration = np.mean(resp_features[['inspi_duration', 'expi_duration']].values, axis=0)
-    mean_inspi_ratio = mean_cycle_duration[0]/mean_cycle_duration.sum()
-    times = np.arange(0,data.shape[1])/srate
+def stretch_data_tf(resp_features, nb_point_by_cycle, data, srate, memmap_name=None):
 
     #### stretch
-    if stretch_TF_auto:
+    data_stretch, mean_inspi_ratio = stretch_data_tf_allchan(resp_features, nb_point_by_cycle, data.reshape(1, data.shape[0], -1), srate, memmap_name=memmap_name)
+    data_stretch = data_stretch[:, 0, :, :]
 
-        cycles = physio.deform_traces_to_cycle_template(data.T, times, cycle_times, points_per_cycle=nb_point_by_cycle, 
-                segment_ratios=mean_inspi_ratio, output_mode='stacked')
-    else:
-        
-        cycles = physio.deform_traces_to_cycle_template(data.T, times, cycle_times, points_per_cycle=nb_point_by_cycle, 
-                segment_ratios=ratio_stretch_TF, output_mode='stacked')
+    #### inspect
+    if debug == True:
 
-    #### clean
-    mask = resp_features[resp_features['select'] == 1].index.values
-    cycle_clean = cycles[mask, :, :]
+        plt.pcolormesh(np.mean(data_stretch, axis=0))
+        plt.show()
+
+    return data_stretch, mean_inspi_ratio
 
-    #### reshape
-    if np.iscomplex(data[0,0]):
-        data_stretch = np.zeros(( cycle_clean.shape[0], data.shape[0], nb_point_by_cycle ), dtype='complex')
-    else:
-        data_stretch = np.zeros(( cycle_clean.shape[0], data.shape[0], nb_point_by_cycle ))
 
-    for cycle_i in range(cycle_clean.shape[0]):
 
-        data_stretch[cycle_i, :, :] = cycle_clean[cycle_i,:,:].T
+#resp_features, nb_point_by_cycle, data, srate = respfeatures_allcond[cond][odor_i], stretch_point_TF, tf[n_chan,:,:], srate
+def stretch_data_tf_accumulate(resp_features, nb_point_by_cycle, data, srate, median=True):
+    """
+    Same warp as stretch_data_tf but every cycle is folded in running stats instead of being stacked.
+    Memory is O(freq * nb_point_by_cycle) whatever the cycle count.
+    Returns {'n_cycles', 'mean', 'std', 'median'} of shape (freq, point), median is approximated with P²
+    (on the modulus if data is complex).
+    """
+
+    stretch_operator, mean_inspi_ratio = get_stretch_operator(resp_features, nb_point_by_cycle, data.shape[-1], srate)
+    n_cycles = stretch_operator.shape[0] // nb_point_by_cycle
+    shape_stretch = data.shape[:-1] + (nb_point_by_cycle,)
+
+    data_time = data.reshape(-1, data.shape[-1]).T
+    
+    welford_state = welford_init(shape_stretch, dtype='complex' if np.iscomplexobj(data) else 'float64')
+    if median:
+        median_state = p2_quantile_init(0.5, shape_stretch)
+
+    for cycle_i in range(n_cycles):
+
+        #### warp one cycle (point, ...) -> (..., point)
+        cycle_operator = stretch_operator[cycle_i*nb_point_by_cycle:(cycle_i+1)*nb_point_by_cycle]
+        cycle_stretch = (cycle_operator @ data_time).T.reshape(shape_stretch)
+
+        welford_update(welford_state, cycle_stretch)
+        if median:
+            p2_quantile_update(median_state, np.abs(cycle_stretch) if np.iscomplexobj(cycle_stretch) else cycle_stretch)
+
+    stretch_mean, stretch_std = welford_finalize(welford_state)
+
+    stretch_stats = {'n_cycles' : n_cycles, 'mean' : stretch_mean, 'std' : stretch_std, 
+                     'median' : p2_quantile_value(median_state) if median else None}
 
     #### inspect
     if debug == True:
 
-        plt.pcolormesh(np.mean(data_stretch, axis=0))
+        plt.pcolormesh(stretch_stats['mean'].real)
         plt.show()
 
-    return data_stretch, mean_inspi_ratio
+    return stretch_stats, mean_inspi_ratio
+
+
+
+#data_stretch = tf_stretch_memmap
+def get_stretch_mean(data_stretch, n_cycle_chunk=50):
+    """
+    Mean across cycles (axis 0) reading n_cycle_chunk cycles at a time, for memmap stretch.
+    """
+
+    dtype_sum = 'complex' if np.iscomplexobj(data_stretch) else 'float64'
+    data_sum = np.zeros(data_stretch.shape[1:], dtype=dtype_sum)
+
+    for cycle_start in range(0, data_stretch.shape[0], n_cycle_chunk):
+        data_sum += np.sum(data_stretch[cycle_start:cycle_start+n_cycle_chunk], axis=0, dtype=dtype_sum)
+
+    return data_sum / data_stretch.shape[0]
+
+
+
+#data_stretch = tf_stretch_memmap
+def get_stretch_median(data_stretch, n_sel_chunk=1):
+    """
+    Median across cycles (axis 0) computed by chunk on axis 1 (chan or freq), for memmap stretch.
+    Only n_cycles * n_sel_chunk * (remaining axes) values are loaded at a time.
+    """
+
+    data_median = np.zeros(data_stretch.shape[1:], dtype=data_stretch.dtype)
+
+    for sel_start in range(0, data_stretch.shape[1], n_sel_chunk):
+        sel = slice(sel_start, sel_start + n_sel_chunk)
+        data_median[sel] = np.median(np.asarray(data_stretch[:, sel]), axis=0)
+
+    return data_median
 
 
 
@@ -1047,26 +1283,114 @@ def modify_name(chan_list):
 
 
 
-def shuffle_CycleFreq(x):
-
-    cut = int(np.random.randint(low=0, high=len(x), size=1))
-    x_cut1 = x[:cut]
-    x_cut2 = x[cut:]*-1
-    x_shift = np.concatenate((x_cut2, x_cut1), axis=0)
+def shuffle_CycleFreq(x, seed=None):
 
-    return x_shift
+    return get_surrogates(x, 1, method='CycleFreq', seed=seed)[0]
     
 
-def shuffle_Cxy(x):
-   half_size = x.shape[0]//2
-   ind = np.random.randint(low=0, high=half_size)
-   x_shift = x.copy()
-   
-   x_shift[ind:ind+half_size] *= -1
-   if np.random.rand() >=0.5:
-       x_shift *= -1
+def shuffle_Cxy(x, seed=None):
+
+    return get_surrogates(x, 1, method='Cxy', seed=seed)[0]
+
+
+
+#n_times, n_surr, method = x.shape[-1], 1000, 'CycleFreq'
+def get_surrogates_params(n_times, n_surr, method='CycleFreq', seed=None):
+    """
+    Random draws of n_surr surrogates, same draws for the batch and the lazy mode.
+    'CycleFreq' : cuts of shuffle_CycleFreq, 'Cxy' : inds and global flips of shuffle_Cxy.
+    seed None : the seed is drawn from the global state, so np.random.seed keeps the surrogates reproducible.
+    """
+
+    if seed is None:
+        seed = np.random.randint(2**31)
+
+    rng = np.random.default_rng(seed)
+
+    if method == 'CycleFreq':
+        surr_params = {'cuts' : rng.integers(low=0, high=n_times, size=n_surr)}
+    elif method == 'Cxy':
+        surr_params = {'inds' : rng.integers(low=0, high=n_times//2, size=n_surr), 'flips' : rng.random(n_surr) >= 0.5}
+    else:
+        raise ValueError(f"method must be 'CycleFreq' or 'Cxy', not {method}")
+
+    return surr_params
+
+
+
+#n_times, surr_params, method = x.shape[-1], get_surrogates_params(x.shape[-1], 1000), 'CycleFreq'
+def get_surrogates_index(n_times, surr_params, method='CycleFreq', sign_only=False):
+    """
+    Surrogates as index arrays : surr = x[..., index] * sign, index and sign of shape (n_surr, n_times).
+    index is None for 'Cxy', or with sign_only (the int64 index is 8 times the int8 sign).
+    """
+
+    times = np.arange(n_times)
+
+    if method == 'CycleFreq':
+        cuts = surr_params['cuts'].reshape(-1,1)
+        index = None if sign_only else (times + cuts) % n_times
+        sign = np.where(times < n_times - cuts, -1, 1).astype('int8')
 
-   return x_shift
+    elif method == 'Cxy':
+        inds = surr_params['inds'].reshape(-1,1)
+        index = None
+        sign = np.where((times >= inds) & (times < inds + n_times//2), -1, 1).astype('int8')
+        sign[surr_params['flips']] *= -1
+
+    return index, sign
+
+
+
+#x, n_surr = data_chan, 1000
+def get_surrogates(x, n_surr, method='CycleFreq', seed=None):
+    """
+    Batch of n_surr surrogates of x (..., time) at once, shape (n_surr, ..., time).
+    Same surrogates as shuffle_CycleFreq / shuffle_Cxy, drawn from a np.random.Generator seeded by seed or by the global state.
+    """
+
+    n_times = x.shape[-1]
+    surr_params = get_surrogates_params(n_times, n_surr, method=method, seed=seed)
+    _, sign = get_surrogates_index(n_times, surr_params, method=method, sign_only=True)
+
+    if method == 'CycleFreq':
+        # circular shifts are strided windows on x repeated twice
+        x_windows = np.lib.stride_tricks.sliding_window_view(np.concatenate((x, x), axis=-1), n_times, axis=-1)
+        x_surr = np.moveaxis(x_windows[..., surr_params['cuts'], :], -2, 0) * sign.reshape((n_surr,) + (1,)*(x.ndim-1) + (n_times,))
+    else:
+        x_surr = x[np.newaxis] * sign.reshape((n_surr,) + (1,)*(x.ndim-1) + (n_times,))
+
+    return x_surr
+
+
+
+#x, n_surr = data_chan, 100000
+def iter_surrogates(x, n_surr, method='CycleFreq', seed=None):
+    """
+    Lazy version of get_surrogates for large n_surr, yields one surrogate (..., time) at a time.
+    """
+
+    n_times = x.shape[-1]
+    surr_params = get_surrogates_params(n_times, n_surr, method=method, seed=seed)
+
+    if method == 'CycleFreq':
+        x_twice = np.concatenate((x, x), axis=-1)
+
+    for surr_i in range(n_surr):
+
+        if method == 'CycleFreq':
+            cut = surr_params['cuts'][surr_i]
+            x_surr = x_twice[..., cut:cut+n_times].copy()
+            x_surr[..., :n_times-cut] *= -1
+
+        else:
+            ind = surr_params['inds'][surr_i]
+            x_surr = x.copy()
+            x_surr[..., ind:ind+n_times//2] *= -1
+            if surr_params['flips'][surr_i]:
+                x_surr *= -1
+
+        yield x_surr
 
 
 def Kullback_Leibler_Distance(a, b):
@@ -1132,6 +1456,108 @@ def get_MVL(x):
 
 
 
+def Modulation_Index_batch(distrib, axis=-1):
+    """
+    Modulation_Index (= Shannon_MI) of many distributions at once, bins along axis.
+    """
+
+    distrib = np.asarray(distrib, dtype=float)
+    N = distrib.shape[axis]
+    entropy = -np.sum(np.where(distrib > 0, distrib * np.log(np.where(distrib > 0, distrib, 1)), 0), axis=axis)
+
+    return (np.log(N) - entropy) / np.log(N)
+
+
+
+def get_MVL_batch(x, axis=-1):
+    """
+    get_MVL of many phase profiles at once, phase bins along axis.
+    """
+
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    _phase = np.arange(0, x.shape[-1])*2*np.pi/x.shape[-1]
+
+    return np.abs(x @ np.exp(1j*_phase)) / x.shape[-1]
+
+
+
+#phase, n_bins, shifts = respi_phase, 18, np.array([0])
+def get_phase_bin_operator(phase, n_bins, shifts):
+    """
+    Sparse (time, shift*bin) one hot operator : amplitude @ operator gives the amplitude summed by phase bin,
+    one block of n_bins by circular shift of the phase (shift 0 = observed, others = surrogates).
+    """
+
+    n_times = phase.shape[0]
+    bin_i = (np.mod(phase, 2*np.pi) / (2*np.pi) * n_bins).astype('int64')
+    bin_i = np.minimum(bin_i, n_bins - 1)
+
+    rows = np.tile(np.arange(n_times), shifts.size)
+    cols = (np.arange(shifts.size).reshape(-1,1) * n_bins + bin_i[(np.arange(n_times) - shifts.reshape(-1,1)) % n_times]).reshape(-1)
+
+    return scipy.sparse.csr_matrix((np.ones(rows.size), (rows, cols)), shape=(n_times, shifts.size*n_bins))
+
+
+
+#phase, amplitude = respi_phase, tf[:,:,:]
+def get_pac_batch(phase, amplitude, n_bins=18, n_surr=0, surr_block=None, seed=None, mem_budget=perm_mem_budget):
+    """
+    Phase amplitude coupling of every (chan, freq) with one phase, MI and MVL on the binned amplitude.
+    ------------
+    Inputs =
+    - phase : (time,) phase in radian (respi phase)
+    - amplitude : (chan, freq, time) or (freq, time) amplitude
+    - n_surr : surrogates by random circular shift of the phase, computed by blocks of surr_block
+    - surr_block : None sets it from mem_budget, the bin operator holding n_times nonzeros by shift
+    - seed : None draws it from the global state (np.random.seed), as get_surrogates_params
+    
+    Output = dict with
+    - 'distrib' : (chan, freq, bin) normalized amplitude distribution
+    - 'MI', 'MVL' : (chan, freq)
+    - 'MI_surr', 'MVL_surr' : (surr, chan, freq)
+    """
+
+    shape_feat = amplitude.shape[:-1]
+    n_times = amplitude.shape[-1]
+    amplitude_2d = amplitude.reshape(-1, n_times)
+
+    #### about 40 bytes by nonzero while building the csr operator (int64 rows / cols, coo then csr)
+    if surr_block is None:
+        surr_block = int(max(mem_budget // (40 * n_times), 1))
+
+    if seed is None:
+        seed = np.random.randint(2**31)
+
+    rng = np.random.default_rng(seed)
+    shifts_all = np.concatenate(([0], rng.integers(low=1, high=n_times, size=n_surr)))
+
+    MI = np.zeros((n_surr + 1, amplitude_2d.shape[0]))
+    MVL = np.zeros((n_surr + 1, amplitude_2d.shape[0]))
+
+    for block_start in range(0, shifts_all.size, surr_block):
+
+        shifts = shifts_all[block_start:block_start+surr_block]
+        bin_operator = get_phase_bin_operator(phase, n_bins, shifts)
+
+        #### mean amplitude by bin for every feat and shift
+        bin_count = np.asarray(bin_operator.sum(axis=0)).reshape(shifts.size, n_bins)
+        amp_binned = (amplitude_2d @ bin_operator).reshape(-1, shifts.size, n_bins) / np.maximum(bin_count, 1)
+        distrib = amp_binned / amp_binned.sum(axis=-1, keepdims=True)
+
+        MI[block_start:block_start+shifts.size] = Modulation_Index_batch(distrib).T
+        MVL[block_start:block_start+shifts.size] = get_MVL_batch(amp_binned).T
+
+        if block_start == 0:
+            distrib_obs = distrib[:, 0, :]
+
+    pac = {'distrib' : distrib_obs.reshape(shape_feat + (n_bins,)),
+           'MI' : MI[0].reshape(shape_feat), 'MVL' : MVL[0].reshape(shape_feat),
+           'MI_surr' : MI[1:].reshape((n_surr,) + shape_feat), 'MVL_surr' : MVL[1:].reshape((n_surr,) + shape_feat)}
+
+    return pac
+
+
+
 
 
 
@@ -1166,93 +1592,427 @@ def print_advancement(i, i_final, steps=[25, 50, 75]):
 
 
 
-################################
-######## NORMALIZATION ########
-################################
 
+########################################
+######## STREAMING STATS ########
+########################################
 
-def zscore(x):
 
-    x_zscore = (x - x.mean()) / x.std()
+#q, shape = 0.10, ()
+def p2_quantile_init(q, shape=()):
+    """
+    Running quantile estimator (P² algorithm, Jain & Chlamtac 1985), vectorized over cells of shape.
+    Memory is 5 markers by cell whatever the number of observations.
+    """
 
-    return x_zscore
+    state = {'q' : q, 'n' : 0,
+             'heights' : np.zeros((5,) + tuple(shape)),
+             'pos' : np.ones((5,) + tuple(shape)) * np.arange(1, 6).reshape((5,) + (1,)*len(shape)),
+             'desired' : np.ones((5,) + tuple(shape)) * np.array([1, 1+2*q, 1+4*q, 3+2*q, 5]).reshape((5,) + (1,)*len(shape)),
+             'incr' : np.array([0, q/2, q, (1+q)/2, 1]).reshape((5,) + (1,)*len(shape))}
 
+    return state
 
 
 
-def zscore_mat(x):
+#state, x = q10_state, resp[0]
+def p2_quantile_update(state, x):
+    """
+    Fold one observation by cell (x has the shape given to p2_quantile_init) in the P² state, inplace.
+    """
 
-    _zscore_mat = (x - x.mean(axis=1).reshape(-1,1)) / x.std(axis=1).reshape(-1,1)
+    heights, pos, desired = state['heights'], state['pos'], state['desired']
+    x = np.asarray(x, dtype='float64')
 
-    return _zscore_mat
+    #### first 5 observations initiate the markers
+    if state['n'] < 5:
+        heights[state['n']] = x
+        state['n'] += 1
+        if state['n'] == 5:
+            heights.sort(axis=0)
+        return state
 
+    state['n'] += 1
 
+    #### find cell and shift positions
+    heights[0] = np.minimum(heights[0], x)
+    heights[4] = np.maximum(heights[4], x)
+    k = (x >= heights[1:4]).sum(axis=0)
+    pos += np.arange(5).reshape((5,) + (1,)*x.ndim) > k
+    desired += state['incr']
 
-def rscore(x):
+    #### adjust inner markers, parabolic then linear if parabolic leaves the bracket
+    for i in (1, 2, 3):
 
-    mad = np.median( np.abs(x-np.median(x)) ) # median_absolute_deviation
+        d = desired[i] - pos[i]
+        move = ((d >= 1) & (pos[i+1] - pos[i] > 1)) | ((d <= -1) & (pos[i-1] - pos[i] < -1))
 
-    rzscore_x = (x-np.median(x)) * 0.6745 / mad
+        if not np.any(move):
+            continue
 
-    return rzscore_x
-    
+        d = np.sign(d)
+        h_parab = heights[i] + d / (pos[i+1] - pos[i-1]) * ((pos[i] - pos[i-1] + d) * (heights[i+1] - heights[i]) / (pos[i+1] - pos[i])
+                                                            + (pos[i+1] - pos[i] - d) * (heights[i] - heights[i-1]) / (pos[i] - pos[i-1]))
+        h_next, pos_next = np.where(d > 0, heights[i+1], heights[i-1]), np.where(d > 0, pos[i+1], pos[i-1])
+        h_linear = heights[i] + d * (h_next - heights[i]) / (pos_next - pos[i])
+        h_new = np.where((heights[i-1] < h_parab) & (h_parab < heights[i+1]), h_parab, h_linear)
 
+        heights[i] = np.where(move, h_new, heights[i])
+        pos[i] = np.where(move, pos[i] + d, pos[i])
 
+    return state
 
-def rscore_mat(x):
 
-    mad = np.median(np.abs(x-np.median(x, axis=1).reshape(-1,1)), axis=1) # median_absolute_deviation
 
-    _rscore_mat = (x-np.median(x, axis=1).reshape(-1,1)) * 0.6745 / mad.reshape(-1,1)
+def p2_quantile_value(state):
 
-    return _rscore_mat
+    if state['n'] == 0:
+        return np.full(state['heights'].shape[1:], np.nan)
 
+    if state['n'] < 5:
+        return np.quantile(state['heights'][:state['n']], state['q'], axis=0)
 
+    return state['heights'][2].copy()
 
 
 
 
-#tf_conv = tf_median_cycle[nchan, :, :]
-def norm_tf(sujet, tf_conv, odor_i, norm_method):
+def welford_init(shape=(), dtype='float64'):
 
-    path_source = os.getcwd()
+    state = {'n' : 0, 'mean' : np.zeros(shape, dtype=dtype), 'M2' : np.zeros(shape)}
 
-    if norm_method not in ['rscore', 'zscore']:
+    return state
 
-        #### load baseline
-        os.chdir(os.path.join(path_precompute, sujet, 'baselines'))
 
-        baselines = xr.open_dataarray(f'{sujet}_{odor_i}_baselines.nc')
 
-    if norm_method == 'dB':
+#state, x, axis = baseline_state, tf_chunk, -1
+def welford_update(state, x, axis=None):
+    """
+    Fold observations in running mean / M2 (Welford, Chan et al. merge for batches), inplace.
+    axis=None : x is one observation of the state shape, else x is a batch of observations along axis.
+    Works with complex data, M2 being the sum of |x - mean|**2.
+    """
 
-        for n_chan_i, n_chan in enumerate(chan_list_eeg):
+    if axis is None:
+        x, axis = np.asarray(x)[np.newaxis], 0
 
-            tf_conv[n_chan_i,:,:] = 10*np.log10(tf_conv[n_chan_i,:,:] / baselines.loc[n_chan, :, 'median'].values.reshape(-1,1))
+    n_batch = x.shape[axis]
 
-    if norm_method == 'zscore_baseline':
+    if n_batch == 0:
+        return state
 
-        for n_chan_i, n_chan in enumerate(chan_list_eeg):
+    mean_batch = np.mean(x, axis=axis)
+    M2_batch = np.sum(np.abs(x - np.expand_dims(mean_batch, axis))**2, axis=axis)
 
-            tf_conv[n_chan_i,:,:] = (tf_conv[n_chan_i,:,:] - baselines.loc[n_chan,:,'mean'].values.reshape(-1,1)) / baselines.loc[n_chan,:,'std'].values.reshape(-1,1)
-                
-    if norm_method == 'rscore_baseline':
+    n_tot = state['n'] + n_batch
+    delta = mean_batch - state['mean']
+    state['mean'] += delta * n_batch / n_tot
+    state['M2'] += M2_batch + np.abs(delta)**2 * state['n'] * n_batch / n_tot
+    state['n'] = n_tot
 
-        for n_chan_i, n_chan in enumerate(chan_list_eeg):
+    return state
+
+
+
+def welford_finalize(state, ddof=0):
+
+    mean = state['mean'].copy()
+    std = np.sqrt(state['M2'] / (state['n'] - ddof))
+
+    return mean, std
+
+
+
+
+#x_first, n_bins = tf_chunk, 1000
+def hist_sketch_init(x_first, n_bins=1000, margin=0.5):
+    """
+    Bounded memory quantile sketch for positive data (TF power): a histogram of log10(x) by cell.
+    Bins range is set by cell from the first batch (last axis = observations), widened by margin,
+    and doubled by hist_sketch_update when later values fall outside (n_bins even).
+    """
+
+    log_x = np.log10(np.maximum(x_first, np.finfo(x_first.dtype).tiny)).astype('float64')
+    lo, hi = log_x.min(axis=-1), log_x.max(axis=-1)
+    span = np.maximum(hi - lo, 1e-6)
+
+    state = {'n' : 0, 'n_bins' : n_bins, 'lo' : lo - span*margin, 'width' : span*(1 + 2*margin)/n_bins, 
+             'counts' : np.zeros(lo.shape + (n_bins,), dtype='int64')}
+
+    return state
+
+
+
+#state, log_min, log_max = sketch_state, log_x.min(axis=-1), log_x.max(axis=-1)
+def hist_sketch_extend(state, log_min, log_max):
+    """
+    Double the range of the cells not covering [log_min, log_max], inplace, merging bins by pairs
+    so the counts stay exact at the coarser resolution. Range grows down if log_min is out, else up.
+    """
+
+    n_bins = state['n_bins']
+
+    while True:
+
+        lo, width = state['lo'], state['width']
+        below, above = log_min < lo, log_max >= lo + n_bins*width
+        grow = below | above
+
+        if not np.any(grow):
+            return state
+
+        counts = state['counts']
+        merged = counts.reshape(counts.shape[:-1] + (n_bins//2, 2)).sum(axis=-1)
+        empty = np.zeros_like(merged)
+        counts_grown = np.where(below[..., np.newaxis], np.concatenate((empty, merged), axis=-1), np.concatenate((merged, empty), axis=-1))
+
+        state['counts'] = np.where(grow[..., np.newaxis], counts_grown, counts)
+        state['lo'] = np.where(below, lo - n_bins*width, lo)
+        state['width'] = np.where(grow, 2*width, width)
+
+
+
+#state, x = sketch_state, tf_chunk
+def hist_sketch_update(state, x):
+
+    n_bins = state['n_bins']
+    log_x = np.log10(np.maximum(x, np.finfo(x.dtype).tiny))
+    hist_sketch_extend(state, log_x.min(axis=-1), log_x.max(axis=-1))
+
+    #### bins in the dtype of x (float32 TF power), edge clip only guards rounding
+    bin_i = np.floor((log_x - state['lo'][..., np.newaxis].astype(log_x.dtype)) / state['width'][..., np.newaxis].astype(log_x.dtype))
+    bin_i = np.clip(bin_i, 0, n_bins - 1).astype('int64').reshape(-1, x.shape[-1])
+
+    #### one bincount for all cells
+    n_cells = bin_i.shape[0]
+    flat_i = (np.arange(n_cells).reshape(-1,1) * n_bins + bin_i).reshape(-1)
+    state['counts'] += np.bincount(flat_i, minlength=n_cells*n_bins).reshape(state['counts'].shape)
+    state['n'] += x.shape[-1]
+
+    return state
+
+
+
+def hist_sketch_cdf(state, v):
+    """
+    Fraction of values <= v by cell, linear inside bins.
+    """
+
+    counts = state['counts']
+    cum = np.concatenate((np.zeros(counts.shape[:-1] + (1,)), np.cumsum(counts, axis=-1)), axis=-1)
+
+    pos = (np.log10(np.maximum(v, np.finfo('float64').tiny)) - state['lo']) / state['width']
+    pos = np.clip(pos, 0, state['n_bins'])
+    bin_i = np.minimum(np.floor(pos), state['n_bins'] - 1).astype('int64')[..., np.newaxis]
+
+    cdf = np.take_along_axis(cum, bin_i, axis=-1) + (pos[..., np.newaxis] - bin_i) * np.take_along_axis(counts, bin_i, axis=-1)
+
+    return cdf[..., 0] / state['n']
+
+
+
+def hist_sketch_quantile(state, q):
+
+    counts = state['counts']
+    cum = np.cumsum(counts, axis=-1)
+    target = q * state['n']
+
+    bin_i = np.minimum((cum < target).sum(axis=-1), state['n_bins'] - 1)[..., np.newaxis]
+    cum_before = np.take_along_axis(cum, bin_i, axis=-1) - np.take_along_axis(counts, bin_i, axis=-1)
+    frac = (target - cum_before) / np.maximum(np.take_along_axis(counts, bin_i, axis=-1), 1)
+
+    return 10**(state['lo'] + (bin_i[..., 0] + frac[..., 0]) * state['width'])
+
+
+
+def hist_sketch_median_mad(state, n_iter=50):
+    """
+    Median and mad (not scaled, as in rscore) from the sketch, mad solving cdf(med+t) - cdf(med-t) = 0.5 by bisection.
+    """
+
+    med = hist_sketch_quantile(state, 0.5)
+
+    #### bracket from the highest non empty bin, not the whole (possibly doubled) range
+    last_bin = state['n_bins'] - np.argmax(state['counts'][..., ::-1] > 0, axis=-1)
+    t_lo = np.zeros(med.shape)
+    t_hi = 10**(state['lo'] + last_bin * state['width'])
+
+    for _ in range(n_iter):
+        t = (t_lo + t_hi) / 2
+        inside = hist_sketch_cdf(state, med + t) - hist_sketch_cdf(state, med - t)
+        t_lo, t_hi = np.where(inside < 0.5, t, t_lo), np.where(inside < 0.5, t_hi, t)
+
+    mad = (t_lo + t_hi) / 2
+
+    return med, mad
+
+
+
+
+
+
+################################
+######## NORMALIZATION ########
+################################
+
+
+def zscore(x):
+
+    x_zscore = (x - x.mean()) / x.std()
+
+    return x_zscore
+
+
+
+
+def zscore_mat(x):
+
+    _zscore_mat = (x - x.mean(axis=1).reshape(-1,1)) / x.std(axis=1).reshape(-1,1)
+
+    return _zscore_mat
+
+
+
+def rscore(x):
+
+    med, mad = median_mad(x) # median_absolute_deviation
+
+    rzscore_x = (x-med) * 0.6745 / mad
+
+    return rzscore_x
+    
 
-            tf_conv[n_chan_i,:,:] = (tf_conv[n_chan_i,:,:] - baselines.loc[n_chan,:,'median'].values.reshape(-1,1)) * 0.6745 / baselines.loc[n_chan,:,'mad'].values.reshape(-1,1)
 
-    if norm_method == 'zscore':
 
-        for n_chan_i, n_chan in enumerate(chan_list_eeg):
+def rscore_mat(x):
+
+    med, mad = median_mad(x, axis=1) # median_absolute_deviation
+
+    _rscore_mat = (x-med.reshape(-1,1)) * 0.6745 / mad.reshape(-1,1)
+
+    return _rscore_mat
+
+
+
+
+
+
+#data, wavelets = data[:len(chan_list_eeg),:], get_wavelets()
+def compute_baselines_streaming(data, wavelets, chunk_duration=60, n_bins=1000, n_chan_chunk=4):
+    """
+    Baseline stats of the TF power (chan, freq) in one pass over time chunks of the TF,
+    the full TF is never held in memory, chan are processed by n_chan_chunk to bound the float32 chunk.
+    mean / std with Welford updates, median / mad with a log-histogram sketch (hist_sketch_*).
+    Returns xr.DataArray (chan, freq, metric) as expected by norm_tf.
+    """
+
+    n_chan, n_times = data.shape
+    n_wave = wavelets.shape[-1]
+    n_chunk = int(chunk_duration * srate)
+
+    #### 'same' alignment : output sample i reads input i - (n_wave - 1 - half_wave) to i + half_wave
+    half_wave = (n_wave - 1) // 2
+    margin_left, margin_right = n_wave - 1 - half_wave, half_wave
+
+    #### every inner chunk has the same padded length, its bank FFT is computed once
+    n_pad_inner = n_chunk + margin_left + margin_right
+    wavelets_fft_inner = scipy.fft.fft(np.asarray(wavelets, dtype='complex64'), n=get_tf_nfft(n_pad_inner, n_wave), axis=-1)
+
+    baselines = np.zeros((n_chan, wavelets.shape[0], 4))
+
+    for chan_start in range(0, n_chan, n_chan_chunk):
+
+        chan_sel = slice(chan_start, chan_start + n_chan_chunk)
+        welford_state = welford_init((data[chan_sel].shape[0], wavelets.shape[0]))
+        sketch_state = None
+
+        for chunk_start in range(0, n_times, n_chunk):
+
+            chunk_stop = min(chunk_start + n_chunk, n_times)
+
+            #### convolve the chunk with half wavelet margins, same values as the full signal TF
+            pad_start, pad_stop = max(chunk_start - margin_left, 0), min(chunk_stop + margin_right, n_times)
+            wavelets_fft = wavelets_fft_inner if pad_stop - pad_start == n_pad_inner else None
+            tf_chunk = compute_tf_fft(data[chan_sel, pad_start:pad_stop], wavelets, output='power', wavelets_fft=wavelets_fft)
+            tf_chunk = tf_chunk[:, :, chunk_start - pad_start:chunk_stop - pad_start]
+
+            welford_update(welford_state, tf_chunk, axis=-1)
+
+            if sketch_state is None:
+                sketch_state = hist_sketch_init(tf_chunk, n_bins=n_bins)
+            hist_sketch_update(sketch_state, tf_chunk)
+
+        baselines[chan_sel, :, 0], baselines[chan_sel, :, 1] = welford_finalize(welford_state)
+        baselines[chan_sel, :, 2], baselines[chan_sel, :, 3] = hist_sketch_median_mad(sketch_state)
+
+    baselines = xr.DataArray(baselines, dims=['chan', 'freq', 'metric'], 
+                             coords={'chan' : chan_list_eeg[:n_chan], 'freq' : np.arange(wavelets.shape[0]), 'metric' : ['mean', 'std', 'median', 'mad']})
+
+    return baselines
+
+
+
+#sujet, cond, odor_i = '01NM_MW', 'VS', 'o'
+def precompute_baselines_streaming(sujet, cond, odor_i):
+
+    data = load_data_sujet(sujet, cond, odor_i)[:len(chan_list_eeg),:]
+
+    baselines = compute_baselines_streaming(data, get_wavelets())
+    baselines = baselines.assign_coords(freq=frex)
+
+    os.makedirs(os.path.join(path_precompute, sujet, 'baselines'), exist_ok=True)
+    baselines.to_netcdf(os.path.join(path_precompute, sujet, 'baselines', f'{sujet}_{odor_i}_baselines.nc'))
+
+    print(f'#### baselines saved : {sujet} {odor_i}', flush=True)
+
+
+
+
+#tf_conv = tf_median_cycle[nchan, :, :]
+def norm_tf(sujet, tf_conv, odor_i, norm_method):
+
+    path_source = os.getcwd()
+
+    if norm_method not in ['rscore', 'zscore']:
+
+        #### load baseline
+        os.chdir(os.path.join(path_precompute, sujet, 'baselines'))
 
-            tf_conv[n_chan_i,:,:] = zscore_mat(tf_conv[n_chan_i,:,:])
+        baselines = xr.open_dataarray(f'{sujet}_{odor_i}_baselines.nc')
+
+    #### all chan at once, inplace on (chan, freq, time)
+    tf_eeg = tf_conv[:len(chan_list_eeg)]
+
+    if norm_method in ['dB', 'zscore_baseline', 'rscore_baseline']:
+
+        baselines_mat = {metric : baselines.loc[chan_list_eeg, :, metric].values[:, :, np.newaxis] for metric in ['mean', 'std', 'median', 'mad']}
+
+    if norm_method == 'dB':
+
+        tf_eeg /= baselines_mat['median']
+        np.log10(tf_eeg, out=tf_eeg)
+        tf_eeg *= 10
+
+    if norm_method == 'zscore_baseline':
+
+        tf_eeg -= baselines_mat['mean']
+        tf_eeg /= baselines_mat['std']
                 
-    if norm_method == 'rscore':
+    if norm_method == 'rscore_baseline':
 
-        for n_chan_i, n_chan in enumerate(chan_list_eeg):
+        tf_eeg -= baselines_mat['median']
+        tf_eeg *= 0.6745 / baselines_mat['mad']
 
-            tf_conv[n_chan_i,:,:] = rscore_mat(tf_conv[n_chan_i,:,:])
+    if norm_method == 'zscore':
+
+        tf_eeg -= tf_eeg.mean(axis=-1, keepdims=True)
+        tf_eeg /= tf_eeg.std(axis=-1, keepdims=True)
+                
+    if norm_method == 'rscore':
+
+        med, mad = median_mad(tf_eeg, axis=-1)
+        tf_eeg -= med[..., np.newaxis]
+        tf_eeg *= 0.6745 / mad[..., np.newaxis]
 
 
     #### verify baseline
@@ -1751,8 +2511,56 @@ def nk_analysis(ecg_i, srate):
 ########################################
 
 
+#n_trial_tot, n_surr = 60, 1000
+def get_permutation_index(n_trial_tot, n_surr, seed=None):
+    """
+    All the trial permutations at once, (n_surr, n_trial_tot).
+    Same draws as np.random.choice(n_trial_tot, size=n_trial_tot, replace=False) in a loop,
+    from the global state (np.random.seed) or from np.random.RandomState(seed).
+    In pool workers pass a seed, forked workers share a copy of the global state and would draw the same permutations.
+    """
+
+    random_state = np.random if seed is None else np.random.RandomState(seed)
+
+    return np.stack([random_state.permutation(n_trial_tot) for surr_i in range(n_surr)])
+
+
+
+#data_shuffle, random_sel = data_shuffle, random_sel[:, n_trials_min:n_trials_min*2]
+def get_surrogate_median_minmax(data_shuffle, random_sel, mem_budget=perm_mem_budget):
+    """
+    min and max over time of the median of data_shuffle[random_sel[surr_i]] for every surrogate, (n_surr, 2).
+    Surrogates are gathered by blocks of at most mem_budget bytes.
+    """
+
+    n_surr, n_sel = random_sel.shape
+    surr_bytes = n_sel * np.prod(data_shuffle.shape[1:]) * data_shuffle.dtype.itemsize
+    n_surr_block = int(np.clip(mem_budget // surr_bytes, 1, n_surr))
+
+    pixel_based_distrib = np.zeros((n_surr, 2))
+
+    for surr_start in range(0, n_surr, n_surr_block):
+
+        surr_stop = min(surr_start + n_surr_block, n_surr)
+
+        #### (surr, trial, time) gather is a copy, can be partitioned inplace
+        data_block = data_shuffle[random_sel[surr_start:surr_stop]]
+        median_block, _ = partition_median(data_block, axis=1, overwrite_input=True)
+        median_block = median_block.reshape(surr_stop - surr_start, -1)
+
+        pixel_based_distrib[surr_start:surr_stop, 0] = median_block.min(axis=1)
+        pixel_based_distrib[surr_start:surr_stop, 1] = median_block.max(axis=1)
+
+    return pixel_based_distrib
+
+
+
 # data_baseline, data_cond = data_baseline_chan, data_cond_chan
-def get_permutation_cluster_1d(data_baseline, data_cond, n_surr):
+def get_permutation_cluster_1d(data_baseline, data_cond, n_surr, seed=None, mem_budget=perm_mem_budget, sequential=False, seq_block=50, seq_error=1e-3):
+    """
+    sequential : surrogates by blocks of seq_block, stops once no point of the mean cond lies in the (1-seq_error)
+    interval of the min or max threshold (medians of the surrogate distribution), so the mask can not change anymore.
+    """
 
     n_trials_baselines = data_baseline.shape[0]
     n_trials_cond = data_cond.shape[0]
@@ -1761,34 +2569,36 @@ def get_permutation_cluster_1d(data_baseline, data_cond, n_surr):
     data_shuffle = np.concatenate((data_baseline, data_cond), axis=0)
     n_trial_tot = data_shuffle.shape[0]
 
-    ttest_vec_shuffle = np.zeros((n_surr, data_cond.shape[-1]))
+    #### shuffle, all surrogates at once
+    random_sel = get_permutation_index(n_trial_tot, n_surr, seed=seed)
 
-    pixel_based_distrib = np.zeros((n_surr, 2))
+    if debug:
+        data_shuffle_baseline = data_shuffle[random_sel[0, :n_trials_min]]
+        data_shuffle_cond = data_shuffle[random_sel[0, n_trials_min:n_trials_min*2]]
+        plt.plot(np.mean(data_shuffle_baseline, axis=0), label='baseline')
+        plt.plot(np.mean(data_shuffle_cond, axis=0), label='cond')
+        plt.legend()
+        plt.show()
 
-    for surr_i in range(n_surr):
+    #### extract max min
+    if sequential:
 
-        #### shuffle
-        random_sel = np.random.choice(n_trial_tot, size=n_trial_tot, replace=False)
-        data_shuffle_baseline = data_shuffle[random_sel[:n_trials_min]]
-        data_shuffle_cond = data_shuffle[random_sel[n_trials_min:n_trials_min*2]]
-
-        if debug:
-            plt.plot(np.mean(data_shuffle_baseline, axis=0), label='baseline')
-            plt.plot(np.mean(data_shuffle_cond, axis=0), label='cond')
-            plt.legend()
-            plt.show()
-
-            plt.plot(ttest_vec_shuffle[surr_i,:], label='shuffle')
-            plt.hlines(0.05, xmin=0, xmax=data_shuffle.shape[-1], color='r')
-            plt.legend()
-            plt.show()
-
-        #### extract max min
-        _min, _max = np.median(data_shuffle_cond, axis=0).min(), np.median(data_shuffle_cond, axis=0).max()
-        # _min, _max = np.percentile(np.median(tf_shuffle, axis=0), 1, axis=1), np.percentile(np.median(tf_shuffle, axis=0), 99, axis=1)
-        
-        pixel_based_distrib[surr_i, 0] = _min
-        pixel_based_distrib[surr_i, 1] = _max
+        data_thresh = np.mean(data_cond, axis=0)
+        pixel_based_distrib = np.zeros((0, 2))
+
+        for surr_start in range(0, n_surr, seq_block):
+
+            random_sel_block = random_sel[surr_start:surr_start+seq_block, n_trials_min:n_trials_min*2]
+            pixel_based_distrib = np.concatenate((pixel_based_distrib, get_surrogate_median_minmax(data_shuffle, random_sel_block, mem_budget=mem_budget)), axis=0)
+
+            (min_low, max_low), (min_high, max_high) = median_ci(pixel_based_distrib, error=seq_error, axis=0)
+            if not np.any(((data_thresh >= min_low) & (data_thresh <= min_high)) | ((data_thresh >= max_low) & (data_thresh <= max_high))):
+                break
+
+    else:
+
+        pixel_based_distrib = get_surrogate_median_minmax(data_shuffle, random_sel[:, n_trials_min:n_trials_min*2], mem_budget=mem_budget)
+    # _min, _max = np.percentile(np.median(tf_shuffle, axis=0), 1, axis=1), np.percentile(np.median(tf_shuffle, axis=0), 99, axis=1)
 
     min, max = np.median(pixel_based_distrib[:,0]), np.median(pixel_based_distrib[:,1]) 
     # min, max = np.percentile(pixel_based_distrib[:,0], 50), np.percentile(pixel_based_distrib[:,1], 50)
@@ -1847,6 +2657,442 @@ def get_permutation_cluster_1d(data_baseline, data_cond, n_surr):
 
 
 
+#n_trials_baseline, random_sel = n_trials_baselines, random_sel[surr_start:surr_stop]
+def get_perm_group_matrix(n_trials_baseline, random_sel):
+    """
+    (surr, trial) matrix of 0/1 with 1 for the trials drawn in cond : random_sel[:, n_trials_baseline:].
+    """
+
+    group_cond = np.zeros(random_sel.shape)
+    np.put_along_axis(group_cond, random_sel[:, n_trials_baseline:], 1, axis=1)
+
+    return group_cond
+
+
+
+#data_shuffle, group_cond = data_shuffle.reshape(n_trial_tot, -1), group_cond
+def get_tstat_perm_batch(data_shuffle, group_cond):
+    """
+    Welch t (cond - baseline) of data_shuffle (trial, feature) for a block of trial assignments group_cond (surr, trial).
+    Group sums are matrix products, no (surr, trial, feature) gather. Returns (surr, feature).
+    """
+
+    #### t is unchanged by a shift, centering keeps sumsq - n*mean**2 from cancelling on uncentred data (TF power)
+    data_shuffle = data_shuffle - data_shuffle.mean(axis=0)
+
+    n_cond = group_cond.sum(axis=1, keepdims=True)
+    n_baseline = group_cond.shape[1] - n_cond
+
+    #### at most 4 (surr, feature) float64 arrays and one temporary alive, intermediates reused inplace
+    sum_cond = group_cond @ data_shuffle
+    sumsq_cond = group_cond @ data_shuffle**2
+
+    mean_baseline = (data_shuffle.sum(axis=0) - sum_cond) / n_baseline
+    var_baseline = (data_shuffle**2).sum(axis=0) - sumsq_cond
+    var_baseline -= n_baseline * mean_baseline**2
+    var_baseline /= (n_baseline - 1) * n_baseline
+
+    mean_cond = sum_cond
+    mean_cond /= n_cond
+    var_cond = sumsq_cond
+    var_cond -= n_cond * mean_cond**2
+    var_cond /= (n_cond - 1) * n_cond
+
+    #### var_cond becomes the squared denominator, clip only guards constant features
+    var_cond += var_baseline
+    del var_baseline
+    denom = var_cond
+    np.clip(denom, np.finfo('float64').tiny, None, out=denom)
+    np.sqrt(denom, out=denom)
+
+    tstat = mean_cond
+    tstat -= mean_baseline
+    tstat /= denom
+
+    return tstat
+
+
+
+#tstat, thresh = tstat_block, thresh
+def get_cluster_mass(tstat, thresh):
+    """
+    Clusters of a stack of maps tstat (map, ...), t > thresh and t < -thresh, labeled map by map with scipy.ndimage.label.
+    Returns labels (same shape as tstat, 0 outside clusters), mass (sum of |t|) and map index of each label 1..n.
+    """
+
+    #### no connectivity across the map axis
+    structure = np.zeros((3,) + (3,)*(tstat.ndim-1), dtype='bool')
+    structure[1] = scipy.ndimage.generate_binary_structure(tstat.ndim-1, 1)
+
+    #### negative labels merged inplace after the positive ones
+    labels, n_pos = scipy.ndimage.label(tstat > thresh, structure=structure)
+    labels_neg, n_neg = scipy.ndimage.label(tstat < -thresh, structure=structure)
+    np.add(labels_neg, n_pos, out=labels, where=labels_neg > 0)
+    del labels_neg
+
+    mass = np.bincount(labels.reshape(-1), weights=np.abs(tstat).reshape(-1), minlength=n_pos+n_neg+1)[1:]
+
+    map_of_label = np.zeros(n_pos+n_neg+1, dtype='int')
+    map_of_label[labels.reshape(tstat.shape[0], -1)] = np.arange(tstat.shape[0]).reshape(-1,1)
+
+    return labels, mass, map_of_label[1:]
+
+
+
+#tstat, thresh = tstat_block, thresh
+def get_cluster_max_mass(tstat, thresh, adjacency=None):
+    """
+    Max cluster mass of each map of tstat (map, ...), 0 for a map without cluster.
+    Lattice clusters with scipy.ndimage.label, or along a sparse adjacency over the flattened map if given.
+    """
+
+    if adjacency is None:
+        _, mass, map_of_label = get_cluster_mass(tstat, thresh)
+    else:
+        _, mass, map_of_label = get_cluster_mass_sparse(tstat.reshape(tstat.shape[0], -1), thresh, adjacency)
+
+    max_mass = np.zeros(tstat.shape[0])
+    np.maximum.at(max_mass, map_of_label, mass)
+
+    return max_mass
+
+
+
+# data_baseline, data_cond = data_baseline_chan, data_cond_chan
+def get_permutation_cluster_2d(data_baseline, data_cond, n_surr, cluster_alpha=0.05, alpha=0.05, seed=None, mem_budget=perm_mem_budget):
+    """
+    Cluster permutation test on 2-D maps, data (trial, freq, phase) like stretched TF.
+    Pixel threshold from Welch t at cluster_alpha, clusters with scipy.ndimage.label, cluster mass = sum of |t|.
+    Surrogates are drawn by blocks sized to mem_budget, each block reduced to its max cluster mass straight away.
+    Returns the mask (freq, phase) of clusters above the 1-alpha percentile of the max mass distribution.
+    """
+
+    n_trials_baselines = data_baseline.shape[0]
+    n_trials_cond = data_cond.shape[0]
+    map_shape = data_cond.shape[1:]
+
+    data_shuffle = np.concatenate((data_baseline, data_cond), axis=0).reshape(n_trials_baselines + n_trials_cond, -1).astype('float64')
+    n_trial_tot = data_shuffle.shape[0]
+
+    thresh = scipy.stats.t.ppf(1 - cluster_alpha/2, n_trial_tot - 2)
+
+    #### observed clusters
+    group_obs = np.concatenate((np.zeros(n_trials_baselines), np.ones(n_trials_cond))).reshape(1,-1)
+    tstat_obs = get_tstat_perm_batch(data_shuffle, group_obs).reshape((1,) + map_shape)
+    labels, mass, _ = get_cluster_mass(tstat_obs, thresh)
+
+    if mass.size == 0:
+        return np.zeros(map_shape, dtype='bool')
+
+    #### max cluster mass distribution, block by block
+    random_sel = get_permutation_index(n_trial_tot, n_surr, seed=seed)
+
+    # 5 (surr, feature) float64 arrays at the peak of get_tstat_perm_batch, then tstat_block, its labels and |t| in get_cluster_mass
+    n_surr_block = int(np.clip(mem_budget // (6 * data_shuffle.shape[1] * 8), 1, n_surr))
+    max_mass_distrib = np.zeros(n_surr)
+
+    for surr_start in range(0, n_surr, n_surr_block):
+
+        surr_stop = min(surr_start + n_surr_block, n_surr)
+
+        group_cond = get_perm_group_matrix(n_trials_baselines, random_sel[surr_start:surr_stop])
+        tstat_block = get_tstat_perm_batch(data_shuffle, group_cond).reshape((-1,) + map_shape)
+        max_mass_distrib[surr_start:surr_stop] = get_cluster_max_mass(tstat_block, thresh)
+
+    mass_thresh = np.percentile(max_mass_distrib, 100 * (1 - alpha))
+    mask = np.isin(labels[0], np.where(mass > mass_thresh)[0] + 1)
+
+    if debug:
+
+        plt.pcolormesh(tstat_obs[0])
+        plt.contour(mask, levels=[0.5], colors='k')
+        plt.show()
+
+    return mask
+
+
+
+# data_baseline, data_cond = tf_stretch_baseline, tf_stretch_cond
+def get_permutation_cluster_2d_allchan(data_baseline, data_cond, n_surr, cluster_alpha=0.05, alpha=0.05, seed=None, n_jobs=n_core):
+    """
+    get_permutation_cluster_2d for every channel in a process pool, data (trial, chan, freq, phase) as given by stretch_data_tf_allchan.
+    Same permutations for every channel when seed is set, else one seed by channel drawn from the global state
+    (forked workers would all share the same copy of it). Returns masks (chan, freq, phase).
+    """
+
+    n_chan = data_cond.shape[1]
+    n_jobs = min(n_jobs, n_chan)
+    seeds = np.random.randint(2**31, size=n_chan) if seed is None else [seed]*n_chan
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        masks = list(executor.map(get_permutation_cluster_2d, 
+                                  [data_baseline[:,chan_i] for chan_i in range(n_chan)], [data_cond[:,chan_i] for chan_i in range(n_chan)], 
+                                  [n_surr]*n_chan, [cluster_alpha]*n_chan, [alpha]*n_chan, seeds, [perm_mem_budget / n_jobs]*n_chan))
+
+    return np.stack(masks)
+
+
+
+
+chan_adjacency_cache = {}
+
+#chan_list, montage_name = chan_list_eeg, 'standard_1020'
+def get_chan_adjacency(chan_list=chan_list_eeg, montage_name='standard_1020'):
+    """
+    Sparse (chan, chan) electrode adjacency from the montage used in preprocessing (mne, Delaunay triangulation), no self loops.
+    """
+
+    cache_key = (tuple(chan_list), montage_name)
+
+    if cache_key not in chan_adjacency_cache:
+
+        info = mne.create_info(list(chan_list), srate, ch_types='eeg')
+        info.set_montage(montage_name)
+        adjacency, ch_names = mne.channels.find_ch_adjacency(info, ch_type='eeg')
+
+        adjacency = scipy.sparse.csr_matrix(adjacency, dtype='bool')
+        adjacency.setdiag(False)
+        adjacency.eliminate_zeros()
+
+        chan_adjacency_cache[cache_key] = adjacency
+
+    return chan_adjacency_cache[cache_key]
+
+
+
+#chan_adjacency, map_shape = get_chan_adjacency(), (nfrex, stretch_point_TF)
+def get_sensor_lattice_adjacency(chan_adjacency, map_shape):
+    """
+    Sparse adjacency over (chan, *map_shape) flattened in C order : electrode neighbours at the same point,
+    plus direct neighbours along each map axis (time, or freq and phase) on the same electrode.
+    """
+
+    adjacency = scipy.sparse.csr_matrix(chan_adjacency, dtype='float')
+
+    for axis_len in map_shape:
+
+        chain = scipy.sparse.diags([np.ones(axis_len-1), np.ones(axis_len-1)], [-1, 1], shape=(axis_len, axis_len))
+        adjacency = scipy.sparse.kron(adjacency, scipy.sparse.identity(axis_len)) + scipy.sparse.kron(scipy.sparse.identity(adjacency.shape[0]), chain)
+
+    return scipy.sparse.csr_matrix(adjacency, dtype='bool')
+
+
+
+#tstat, thresh, adjacency = tstat_block, thresh, adjacency
+def get_cluster_mass_sparse(tstat, thresh, adjacency):
+    """
+    Same as get_cluster_mass on tstat (map, feature) with clusters along a sparse (feature, feature) adjacency.
+    All the maps are one block diagonal graph and clusters come from one scipy.sparse.csgraph.connected_components call.
+    """
+
+    n_map, n_feat = tstat.shape
+
+    tsign = (tstat > thresh).astype('int8') - (tstat < -thresh).astype('int8')
+    supra = tsign.reshape(-1) != 0
+
+    #### edges between supra threshold points of same sign, offset by map
+    row, col = scipy.sparse.triu(adjacency, k=1).nonzero()
+    map_i, edge_i = np.nonzero((tsign[:, row] != 0) & (tsign[:, row] == tsign[:, col]))
+    offset = map_i * n_feat
+
+    graph = scipy.sparse.coo_matrix((np.ones(edge_i.size, dtype='bool'), (offset + row[edge_i], offset + col[edge_i])), shape=(n_map*n_feat, n_map*n_feat))
+    _, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    #### keep components of supra threshold points, labels 1..n
+    _, labels_supra = np.unique(components[supra], return_inverse=True)
+    labels = np.zeros(n_map*n_feat, dtype='int')
+    labels[supra] = labels_supra + 1
+    n_label = labels.max()
+
+    mass = np.bincount(labels, weights=np.abs(tstat).reshape(-1), minlength=n_label+1)[1:]
+
+    map_of_label = np.zeros(n_label+1, dtype='int')
+    map_of_label[labels.reshape(n_map, n_feat)] = np.arange(n_map).reshape(-1,1)
+
+    return labels.reshape(n_map, n_feat), mass, map_of_label[1:]
+
+
+
+# data_baseline, data_cond = data_baseline_allchan, data_cond_allchan
+def get_permutation_cluster_sensor(data_baseline, data_cond, n_surr, chan_list=chan_list_eeg, cluster_alpha=0.05, alpha=0.05, seed=None, mem_budget=perm_mem_budget):
+    """
+    Spatio-temporal cluster permutation test over all electrodes at once, data (trial, chan, time) or (trial, chan, freq, phase).
+    Clusters follow the montage adjacency between electrodes and the lattice along the other axes,
+    one shared surrogate set for every channel so the permutation cost is paid once.
+    Returns the mask (chan, ...) of clusters above the 1-alpha percentile of the max mass distribution.
+    """
+
+    n_trials_baselines = data_baseline.shape[0]
+    n_trials_cond = data_cond.shape[0]
+    map_shape = data_cond.shape[1:]
+
+    adjacency = get_sensor_lattice_adjacency(get_chan_adjacency(chan_list), map_shape[1:])
+
+    data_shuffle = np.concatenate((data_baseline, data_cond), axis=0).reshape(n_trials_baselines + n_trials_cond, -1).astype('float64')
+    n_trial_tot = data_shuffle.shape[0]
+
+    thresh = scipy.stats.t.ppf(1 - cluster_alpha/2, n_trial_tot - 2)
+
+    #### observed clusters
+    group_obs = np.concatenate((np.zeros(n_trials_baselines), np.ones(n_trials_cond))).reshape(1,-1)
+    tstat_obs = get_tstat_perm_batch(data_shuffle, group_obs)
+    labels, mass, _ = get_cluster_mass_sparse(tstat_obs, thresh, adjacency)
+
+    if mass.size == 0:
+        return np.zeros(map_shape, dtype='bool')
+
+    #### max cluster mass distribution, block by block
+    random_sel = get_permutation_index(n_trial_tot, n_surr, seed=seed)
+
+    # 5 (surr, feature) float64 arrays at the peak of get_tstat_perm_batch, then tstat_block with the int8 signs
+    # on the adjacency edges, components, labels and |t| of get_cluster_mass_sparse
+    n_surr_block = int(np.clip(mem_budget // (8 * data_shuffle.shape[1] * 8), 1, n_surr))
+    max_mass_distrib = np.zeros(n_surr)
+
+    for surr_start in range(0, n_surr, n_surr_block):
+
+        surr_stop = min(surr_start + n_surr_block, n_surr)
+
+        group_cond = get_perm_group_matrix(n_trials_baselines, random_sel[surr_start:surr_stop])
+        tstat_block = get_tstat_perm_batch(data_shuffle, group_cond)
+        max_mass_distrib[surr_start:surr_stop] = get_cluster_max_mass(tstat_block, thresh, adjacency=adjacency)
+
+    mass_thresh = np.percentile(max_mass_distrib, 100 * (1 - alpha))
+    mask = np.isin(labels[0], np.where(mass > mass_thresh)[0] + 1).reshape(map_shape)
+
+    return mask
+
+
+
+
+#tstat = tstat_block
+def get_tfce(tstat, E=0.5, H=2, dh=0.1, adjacency=None, mem_budget=perm_mem_budget):
+    """
+    Threshold-free cluster enhancement of a stack of maps tstat (map, ...) : sum over h of extent(h)**E * h**H * dh.
+    All the thresholds are labeled in one call, stacked along the map axis, positive and negative t separately.
+    Lattice clusters (1-D or 2-D maps), or along a sparse adjacency over the flattened map if given.
+    h is the grid dh, 2*dh, ... whatever the maps, maps are processed by blocks sized from their own max |t|
+    so the (map, h, ...) masks stay within mem_budget.
+    """
+
+    n_map = tstat.shape[0]
+    map_shape = tstat.shape[1:]
+    map_size = int(np.prod(map_shape))
+    tfce = np.zeros(tstat.shape)
+    map_max = np.abs(tstat).reshape(n_map, -1).max(axis=1)
+
+    map_start = 0
+
+    while map_start < n_map:
+
+        #### grow the block while its (map, h, feature) masks, labels and weights fit in mem_budget
+        map_stop, h_max = map_start + 1, map_max[map_start]
+        while map_stop < n_map and 3 * (map_stop - map_start + 1) * (int(max(h_max, map_max[map_stop]) / dh) + 1) * map_size * 8 <= mem_budget:
+            h_max = max(h_max, map_max[map_stop])
+            map_stop += 1
+
+        # prefix of the same dh grid for every block
+        h = np.arange(dh, h_max + dh, dh)
+        tfce[map_start:map_stop] = get_tfce_block(tstat[map_start:map_stop], h, E=E, H=H, dh=dh, adjacency=adjacency)
+        map_start = map_stop
+
+    return tfce
+
+
+
+#tstat_block, h = tstat[:10], np.arange(1, 40) * 0.1
+def get_tfce_block(tstat, h, E=0.5, H=2, dh=0.1, adjacency=None):
+    """
+    get_tfce of a stack of maps on the thresholds h, zeros if h is empty (all |t| < dh).
+    """
+
+    n_map = tstat.shape[0]
+    map_shape = tstat.shape[1:]
+    tfce = np.zeros(tstat.shape)
+
+    if h.size == 0:
+        return tfce
+
+    for sign in [1, -1]:
+
+        #### (map, h, ...) supra threshold masks
+        mask = sign * tstat[:, np.newaxis] >= h.reshape((1, -1) + (1,)*len(map_shape))
+        mask = mask.reshape((n_map * h.size,) + map_shape)
+
+        if adjacency is None:
+            structure = np.zeros((3,) + (3,)*len(map_shape), dtype='bool')
+            structure[1] = scipy.ndimage.generate_binary_structure(len(map_shape), 1)
+            labels, _ = scipy.ndimage.label(mask, structure=structure)
+        else:
+            labels, _, _ = get_cluster_mass_sparse(mask.reshape(n_map * h.size, -1).astype('int8'), 0.5, adjacency)
+
+        #### weight of each cluster : extent**E * h**H * dh
+        labels = labels.reshape(-1)
+        label_h = np.zeros(labels.max()+1)
+        label_h[labels] = np.repeat(np.tile(h, n_map), int(np.prod(map_shape)))
+        label_weight = np.bincount(labels).astype('float')**E * label_h**H * dh
+        label_weight[0] = 0
+
+        tfce += sign * label_weight[labels].reshape((n_map, h.size) + map_shape).sum(axis=1)
+
+    return tfce
+
+
+
+# data_baseline, data_cond = data_baseline_chan, data_cond_chan
+def get_permutation_tfce(data_baseline, data_cond, n_surr, alpha=0.05, E=0.5, H=2, dh=0.1, adjacency=None, seed=None, mem_budget=perm_mem_budget):
+    """
+    TFCE permutation test with max-statistic correction, data (trial, time), (trial, freq, phase)
+    or (trial, chan, ...) with the sparse adjacency of get_sensor_lattice_adjacency.
+    No cluster threshold to tune, surrogates by blocks of get_tstat_perm_batch like the cluster tests.
+    Returns the observed TFCE map and the mask of |tfce| above the 1-alpha percentile of the max |tfce| distribution.
+    """
+
+    n_trials_baselines = data_baseline.shape[0]
+    n_trials_cond = data_cond.shape[0]
+    map_shape = data_cond.shape[1:] if adjacency is None else (int(np.prod(data_cond.shape[1:])),)
+
+    data_shuffle = np.concatenate((data_baseline, data_cond), axis=0).reshape(n_trials_baselines + n_trials_cond, -1).astype('float64')
+    n_trial_tot, n_feat = data_shuffle.shape
+
+    #### observed
+    group_obs = np.concatenate((np.zeros(n_trials_baselines), np.ones(n_trials_cond))).reshape(1,-1)
+    tstat_obs = get_tstat_perm_batch(data_shuffle, group_obs)
+    tfce_obs = get_tfce(tstat_obs.reshape((1,) + map_shape), E=E, H=H, dh=dh, adjacency=adjacency, mem_budget=mem_budget)[0]
+
+    #### max |tfce| distribution, block by block
+    random_sel = get_permutation_index(n_trial_tot, n_surr, seed=seed)
+
+    # 5 (surr, feature) float64 arrays at the peak of get_tstat_perm_batch, then tstat_block and tfce_block,
+    # get_tfce blocks its masks from each surrogate max |t| within mem_budget
+    n_surr_block = int(np.clip(mem_budget // (6 * n_feat * 8), 1, n_surr))
+    max_tfce_distrib = np.zeros(n_surr)
+
+    for surr_start in range(0, n_surr, n_surr_block):
+
+        surr_stop = min(surr_start + n_surr_block, n_surr)
+
+        group_cond = get_perm_group_matrix(n_trials_baselines, random_sel[surr_start:surr_stop])
+        tstat_block = get_tstat_perm_batch(data_shuffle, group_cond).reshape((-1,) + map_shape)
+        tfce_block = get_tfce(tstat_block, E=E, H=H, dh=dh, adjacency=adjacency, mem_budget=mem_budget)
+        max_tfce_distrib[surr_start:surr_stop] = np.abs(tfce_block).reshape(surr_stop - surr_start, -1).max(axis=1)
+
+    tfce_thresh = np.percentile(max_tfce_distrib, 100 * (1 - alpha))
+    mask = np.abs(tfce_obs) > tfce_thresh
+
+    tfce_obs, mask = tfce_obs.reshape(data_cond.shape[1:]), mask.reshape(data_cond.shape[1:])
+
+    if debug:
+
+        plt.plot(tfce_obs.reshape(-1))
+        plt.hlines([-tfce_thresh, tfce_thresh], xmin=0, xmax=tfce_obs.size, color='r')
+        plt.show()
+
+    return tfce_obs, mask
+
+
+
+
 
 ########################################
 ######## CLUSTER WORKING ######## 
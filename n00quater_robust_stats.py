@@ -0,0 +1,186 @@
+
+
+import numpy as np
+import scipy.stats
+
+
+
+
+########################################
+######## MEDIAN MAD KERNELS ########
+########################################
+
+
+#x, axis = data, -1
+def partition_median(x, axis, overwrite_input=False):
+    """
+    Median along axis with np.partition (O(n)) instead of a full sort.
+    Returns the median and the partitioned buffer (x itself if overwrite_input).
+    """
+
+    n = x.shape[axis]
+    k = n // 2
+    kth = [k] if n % 2 else [k-1, k]
+
+    if overwrite_input:
+        x.partition(kth, axis=axis)
+        x_part = x
+    else:
+        x_part = np.partition(x, kth, axis=axis)
+
+    if n % 2:
+        median = np.take(x_part, k, axis=axis)
+    else:
+        median = (np.take(x_part, k-1, axis=axis) + np.take(x_part, k, axis=axis)) / 2
+
+    return median, x_part
+
+
+
+#x, axis, constant = data, 1, 1.4826
+def median_mad(x, axis=None, constant=1., nan_policy='propagate', overwrite_input=False, out=None):
+    """
+    Median and mad (median absolute deviation * constant) in one call, with np.partition.
+    ------------
+    Inputs =
+    - x : array, float32 stays float32
+    - axis : axis of the reduction, None for the flattened array
+    - constant : 1 for raw mad (rscore), 1.4826 or 1/0.6745 to be consistent with std
+    - nan_policy : 'propagate' (nan where a slice has nan) or 'omit' (ignore nan)
+    - overwrite_input : x is used as working buffer (no copy), its values are lost
+    - out : optional (median, mad) arrays filled inplace
+
+    Output =
+    - median, mad
+    """
+
+    x = np.asarray(x)
+
+    if not np.issubdtype(x.dtype, np.floating):
+        x, overwrite_input = x.astype('float64'), True
+
+    if axis is None:
+        x, axis = x.reshape(-1), 0
+
+    nan_mask = np.isnan(x).any(axis=axis)
+
+    #### empty slices give nan, as np.median
+    if x.shape[axis] == 0:
+
+        median = np.full(nan_mask.shape, np.nan, dtype=x.dtype)[()]
+        mad = np.full(nan_mask.shape, np.nan, dtype=x.dtype)[()]
+
+    elif nan_policy == 'omit' and np.any(nan_mask):
+
+        median = np.nanmedian(x, axis=axis)
+        mad = np.nanmedian(np.abs(x - np.expand_dims(median, axis)), axis=axis) * constant
+
+    else:
+
+        median, x_part = partition_median(x, axis, overwrite_input=overwrite_input)
+
+        #### deviations in the partitioned buffer, which is ours at this point
+        np.subtract(x_part, np.expand_dims(median, axis), out=x_part)
+        np.abs(x_part, out=x_part)
+        mad, _ = partition_median(x_part, axis, overwrite_input=True)
+        mad = mad * np.asarray(constant, dtype=mad.dtype)
+
+        if np.any(nan_mask):
+            median = np.where(nan_mask, np.array(np.nan, dtype=median.dtype), median)
+            mad = np.where(nan_mask, np.array(np.nan, dtype=mad.dtype), mad)
+
+    if out is not None:
+        out[0][...] = median
+        out[1][...] = mad
+        return out
+
+    return median, mad
+
+
+
+
+
+########################################
+######## SEQUENTIAL PERMUTATION ########
+########################################
+
+
+#n_exceed, n_draw, alpha, error = 3, 100, 0.05, 1e-3
+def pvalue_decision_settled(n_exceed, n_draw, alpha=0.05, error=1e-3):
+    """
+    True when the Clopper-Pearson interval (coverage 1-error) of the Monte Carlo p-value n_exceed/n_draw excludes alpha :
+    the decision p < alpha can only change with probability error if more resamples are drawn.
+    """
+
+    p_low = scipy.stats.beta.ppf(error/2, n_exceed, n_draw - n_exceed + 1) if n_exceed > 0 else 0.
+    p_high = scipy.stats.beta.ppf(1 - error/2, n_exceed + 1, n_draw - n_exceed) if n_exceed < n_draw else 1.
+
+    return bool(p_low > alpha or p_high < alpha)
+
+
+
+#null_fun, stat_obs = draw_null, np.mean(x) - np.mean(y)
+def sequential_permutation_pvalue(null_fun, stat_obs, n_resamples=999, alpha=0.05, error=1e-3, n_block=50):
+    """
+    Sequential (Besag-Clifford like) two-sided Monte Carlo test on |stat|.
+    null_fun(n) returns n null statistics, drawn by blocks of n_block until the decision at alpha is settled
+    (pvalue_decision_settled) or n_resamples are drawn.
+    Returns the p-value (n_exceed + 1) / (n_draw + 1) and the number of resamples used.
+    """
+
+    n_exceed, n_draw = 0, 0
+
+    while n_draw < n_resamples:
+
+        n_block_i = min(n_block, n_resamples - n_draw)
+        null_stat = null_fun(n_block_i)
+
+        #### relative tolerance on ties like scipy.stats.permutation_test
+        n_exceed += int(np.sum(np.abs(null_stat) >= np.abs(stat_obs) * (1 - 1e-14)))
+        n_draw += n_block_i
+
+        if pvalue_decision_settled(n_exceed, n_draw, alpha=alpha, error=error):
+            break
+
+    return (n_exceed + 1) / (n_draw + 1), n_draw
+
+
+
+#x, error = pixel_based_distrib, 1e-3
+def median_ci(x, error=1e-3, axis=0):
+    """
+    Distribution free (1-error) interval of the median along axis, from binomial order statistics.
+    """
+
+    n = x.shape[axis]
+    k_low = int(scipy.stats.binom.ppf(error/2, n, 0.5))
+    k_low = min(max(k_low - 1, 0), (n-1)//2)
+    k_high = n - 1 - k_low
+
+    x_part = np.partition(x, [k_low, k_high], axis=axis)
+
+    return np.take(x_part, k_low, axis=axis), np.take(x_part, k_high, axis=axis)
+
+
+
+############################
+######## EXECUTE ########
+############################
+
+
+if __name__ == '__main__':
+
+    #### microbenchmark on (chan, time) like artifact detection and TF normalization
+    import time
+
+    x = np.random.default_rng(0).normal(size=(27, 150000)).astype('float32')
+
+    for name, fun in {'np.median (rscore_mat)' : lambda: (np.median(x, axis=1), np.median(np.abs(x - np.median(x, axis=1).reshape(-1,1)), axis=1), np.median(x, axis=1)),
+                      'median_mad' : lambda: median_mad(x, axis=1),
+                      'median_mad overwrite' : lambda: median_mad(x.copy(), axis=1, overwrite_input=True)}.items():
+
+        fun()
+        t_start = time.perf_counter()
+        for _ in range(10):
+            fun()
+        print(f'{name} : {(time.perf_counter() - t_start) / 10 * 1e3:.1f} ms')
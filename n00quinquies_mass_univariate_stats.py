@@ -0,0 +1,428 @@
+
+
+import numpy as np
+import scipy.stats
+import xarray as xr
+
+
+
+
+########################################
+######## DATA ########
+########################################
+
+
+#data, dims, coords = tf_allsujet, ['subject', 'cond', 'chan', 'freq', 'time'], None
+def get_mass_univariate_data(data, dims=None, coords=None, subject_dim='subject', cond_dim='cond'):
+    """
+    (subject, cond, feature...) tensor as xr.DataArray with subject and cond as first dims.
+    data can be an xr.DataArray already, or an array with its dims (default subject, cond, feature_0, ...).
+    """
+
+    if not isinstance(data, xr.DataArray):
+
+        if dims is None:
+            dims = [subject_dim, cond_dim] + [f'feature_{i}' for i in range(np.ndim(data)-2)]
+
+        data = xr.DataArray(data, dims=dims, coords=coords)
+
+    return data.transpose(subject_dim, cond_dim, ...)
+
+
+
+#da, stat, pval, correction = da, tstat, pval, 'fdr'
+def get_stats_xr(da, stat, pval, correction='fdr', df=None, subject_dim='subject', cond_dim='cond'):
+    """
+    xr.Dataset (stat, pval, pval_corr) on the feature dims and coords of da.
+    """
+
+    feature_da = da.isel({subject_dim : 0, cond_dim : 0}, drop=True)
+
+    stats_xr = xr.Dataset({'stat' : feature_da.copy(data=stat), 'pval' : feature_da.copy(data=pval)})
+    stats_xr['pval_corr'] = feature_da.copy(data=pval_correction(pval, method=correction))
+    stats_xr.attrs['correction'] = str(correction)
+
+    if df is not None:
+        stats_xr.attrs['df'] = df
+
+    return stats_xr
+
+
+
+
+########################################
+######## CORRECTION ########
+########################################
+
+
+#pval, method = pval, 'fdr'
+def pval_correction(pval, method='fdr'):
+    """
+    Vectorized multiple comparison correction over every feature of pval (any shape), nan are left out.
+    'fdr' : Benjamini-Hochberg, 'holm' : Holm-Bonferroni, 'bonferroni', None : no correction.
+    """
+
+    pval = np.asarray(pval, dtype='float')
+
+    if method is None:
+        return pval.copy()
+
+    pval_flat = pval.reshape(-1)
+    valid = ~np.isnan(pval_flat)
+    p = pval_flat[valid]
+    m = p.size
+
+    order = np.argsort(p)
+    p_sorted = p[order]
+    rank = np.arange(1, m+1)
+
+    if method == 'fdr':
+        p_corr_sorted = np.minimum.accumulate((p_sorted * m / rank)[::-1])[::-1]
+    elif method == 'holm':
+        p_corr_sorted = np.maximum.accumulate(p_sorted * (m - rank + 1))
+    elif method == 'bonferroni':
+        p_corr_sorted = p_sorted * m
+    else:
+        raise ValueError(f"method must be 'fdr', 'holm', 'bonferroni' or None, not {method}")
+
+    p_corr = np.empty(m)
+    p_corr[order] = np.clip(p_corr_sorted, 0, 1)
+
+    pval_corr = np.full(pval_flat.shape, np.nan)
+    pval_corr[valid] = p_corr
+
+    return pval_corr.reshape(pval.shape)
+
+
+
+
+########################################
+######## TWO CONDITIONS ########
+########################################
+
+
+#da, cond_A, cond_B = da, 'CO2', 'FR_CV'
+def ttest_paired_mass(da, cond_A, cond_B, correction='fdr', subject_dim='subject', cond_dim='cond'):
+    """
+    Paired t-test A - B over subjects for every feature at once.
+    """
+
+    da = get_mass_univariate_data(da, subject_dim=subject_dim, cond_dim=cond_dim)
+    diff = (da.sel({cond_dim : cond_A}) - da.sel({cond_dim : cond_B})).values
+
+    n = np.sum(~np.isnan(diff), axis=0)
+    tstat = np.nanmean(diff, axis=0) / (np.nanstd(diff, axis=0, ddof=1) / np.sqrt(n))
+    pval = 2 * scipy.stats.t.sf(np.abs(tstat), n-1)
+
+    return get_stats_xr(da, tstat, pval, correction=correction, df=n-1, subject_dim=subject_dim, cond_dim=cond_dim)
+
+
+
+#da, cond_A, cond_B = da, 'CO2', 'FR_CV'
+def ttest_ind_mass(da, cond_A, cond_B, equal_var=True, correction='fdr', subject_dim='subject', cond_dim='cond'):
+    """
+    Independent t-test A vs B for every feature at once, each cond holding its own subjects
+    (unequal groups padded with nan along subject).
+    """
+
+    da = get_mass_univariate_data(da, subject_dim=subject_dim, cond_dim=cond_dim)
+    x, y = da.sel({cond_dim : cond_A}).values, da.sel({cond_dim : cond_B}).values
+
+    n_x, n_y = np.sum(~np.isnan(x), axis=0), np.sum(~np.isnan(y), axis=0)
+    var_x, var_y = np.nanvar(x, axis=0, ddof=1), np.nanvar(y, axis=0, ddof=1)
+    mean_diff = np.nanmean(x, axis=0) - np.nanmean(y, axis=0)
+
+    if equal_var:
+        df = n_x + n_y - 2
+        var_pooled = ((n_x - 1) * var_x + (n_y - 1) * var_y) / df
+        tstat = mean_diff / np.sqrt(var_pooled * (1/n_x + 1/n_y))
+    else:
+        se2_x, se2_y = var_x / n_x, var_y / n_y
+        df = (se2_x + se2_y)**2 / (se2_x**2 / (n_x - 1) + se2_y**2 / (n_y - 1))
+        tstat = mean_diff / np.sqrt(se2_x + se2_y)
+
+    pval = 2 * scipy.stats.t.sf(np.abs(tstat), df)
+
+    return get_stats_xr(da, tstat, pval, correction=correction, df=df, subject_dim=subject_dim, cond_dim=cond_dim)
+
+
+
+wilcoxon_null_cache = {}
+
+#n = 12
+def get_wilcoxon_null_cdf(n):
+    """
+    Exact null cdf of the signed rank sum T+ for n untied non zero differences, T+ = 0..n(n+1)/2.
+    """
+
+    if n not in wilcoxon_null_cache:
+
+        counts = np.ones(1)
+        for rank in range(1, n+1):
+            counts = np.concatenate((counts, np.zeros(rank))) + np.concatenate((np.zeros(rank), counts))
+
+        wilcoxon_null_cache[n] = np.cumsum(counts) / counts.sum()
+
+    return wilcoxon_null_cache[n]
+
+
+
+#da, cond_A, cond_B = da, 'CO2', 'FR_CV'
+def wilcoxon_mass(da, cond_A, cond_B, correction='fdr', exact_max_n=50, subject_dim='subject', cond_dim='cond'):
+    """
+    Wilcoxon signed rank test on A - B for every feature at once, zero differences dropped ('wilcox').
+    Exact null distribution for features with n <= exact_max_n and no ties, normal approximation with tie correction otherwise.
+    stat is T+ (sum of the ranks of the positive differences).
+    """
+
+    da = get_mass_univariate_data(da, subject_dim=subject_dim, cond_dim=cond_dim)
+    diff = (da.sel({cond_dim : cond_A}) - da.sel({cond_dim : cond_B})).values
+    feature_shape = diff.shape[1:]
+    diff = diff.reshape(diff.shape[0], -1)
+
+    #### zeros share the lowest ranks, removing them shifts the other ranks by n_zero
+    abs_diff = np.abs(diff)
+    n_zero = np.sum(abs_diff == 0, axis=0)
+    n = diff.shape[0] - n_zero
+    ranks = scipy.stats.rankdata(abs_diff, axis=0) - n_zero
+    r_plus = np.sum(ranks * (diff > 0), axis=0)
+
+    #### sum of t**3 - t over the ties of the non zero differences, from the deficit of their squared ranks
+    tie_term = 12 * (n * (n + 1) * (2*n + 1) / 6 - np.sum(np.where(diff != 0, ranks, 0)**2, axis=0))
+    tie_term = np.round(tie_term, 6)
+
+    mean = n * (n + 1) / 4
+    var = n * (n + 1) * (2*n + 1) / 24 - tie_term / 48
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (r_plus - mean) / np.sqrt(var)
+    pval = np.clip(2 * scipy.stats.norm.sf(np.abs(z)), 0, 1)
+
+    #### exact p for small untied samples
+    for n_i in np.unique(n[(n <= exact_max_n) & (n > 0) & (tie_term == 0)]):
+        sel = (n == n_i) & (tie_term == 0)
+        null_cdf = get_wilcoxon_null_cdf(n_i)
+        r_sel = r_plus[sel].astype('int')
+        p_low = null_cdf[r_sel]
+        p_high = 1 - np.concatenate(([0.], null_cdf))[r_sel]
+        pval[sel] = np.clip(2 * np.minimum(p_low, p_high), 0, 1)
+
+    pval[n == 0] = np.nan
+
+    return get_stats_xr(da, r_plus.reshape(feature_shape), pval.reshape(feature_shape), correction=correction, subject_dim=subject_dim, cond_dim=cond_dim)
+
+
+
+
+########################################
+######## ONE WAY WITHIN ########
+########################################
+
+
+#da = da
+def rm_anova_mass(da, correction='fdr', subject_dim='subject', cond_dim='cond'):
+    """
+    One-way repeated measures ANOVA over cond for every feature at once, complete subjects only.
+    Adds pval_gg, the Greenhouse-Geisser corrected p-value, and its epsilon eps_gg.
+    """
+
+    da = get_mass_univariate_data(da, subject_dim=subject_dim, cond_dim=cond_dim)
+    x = da.values
+    n, k = x.shape[:2]
+
+    grand_mean = x.mean(axis=(0,1))
+    ss_cond = n * np.sum((x.mean(axis=0) - grand_mean)**2, axis=0)
+    ss_subject = k * np.sum((x.mean(axis=1) - grand_mean)**2, axis=0)
+    ss_error = np.sum((x - grand_mean)**2, axis=(0,1)) - ss_cond - ss_subject
+
+    df_cond, df_error = k - 1, (k - 1) * (n - 1)
+    fstat = (ss_cond / df_cond) / (ss_error / df_error)
+    pval = scipy.stats.f.sf(fstat, df_cond, df_error)
+
+    #### Greenhouse-Geisser epsilon from the double centered cond covariance of every feature
+    x_centered = x - x.mean(axis=0)
+    cov = np.einsum('ia...,ib...->ab...', x_centered, x_centered) / (n - 1)
+    cov = cov - cov.mean(axis=0) - cov.mean(axis=1)[:, np.newaxis] + cov.mean(axis=(0,1))
+    eps_gg = np.trace(cov)**2 / (df_cond * np.sum(cov**2, axis=(0,1)))
+    pval_gg = scipy.stats.f.sf(fstat, df_cond * eps_gg, df_error * eps_gg)
+
+    stats_xr = get_stats_xr(da, fstat, pval, correction=correction, df=(df_cond, df_error), subject_dim=subject_dim, cond_dim=cond_dim)
+    stats_xr['eps_gg'] = stats_xr['pval'].copy(data=eps_gg)
+    stats_xr['pval_gg'] = stats_xr['pval'].copy(data=pval_gg)
+    stats_xr['pval_gg_corr'] = stats_xr['pval'].copy(data=pval_correction(pval_gg, method=correction))
+
+    return stats_xr
+
+
+
+#da = da
+def friedman_mass(da, correction='fdr', subject_dim='subject', cond_dim='cond'):
+    """
+    Friedman test over cond for every feature at once, ranks within subject with tie correction.
+    """
+
+    da = get_mass_univariate_data(da, subject_dim=subject_dim, cond_dim=cond_dim)
+    x = da.values
+    n, k = x.shape[:2]
+
+    ranks = scipy.stats.rankdata(x, axis=1)
+    rank_sum = ranks.sum(axis=0)
+
+    #### sum of t**3 - t over the ties of every subject : sum of squared ranks departs from k(k+1)(2k+1)/6 by (t**3 - t)/12
+    tie_term = np.sum(k * (k + 1) * (2*k + 1) / 6 - np.sum(ranks**2, axis=1), axis=0) * 12
+
+    chi2 = 12 / (n * k * (k + 1)) * np.sum(rank_sum**2, axis=0) - 3 * n * (k + 1)
+    chi2 = chi2 / (1 - tie_term / (n * k * (k**2 - 1)))
+    pval = scipy.stats.chi2.sf(chi2, k - 1)
+
+    return get_stats_xr(da, chi2, pval, correction=correction, df=k-1, subject_dim=subject_dim, cond_dim=cond_dim)
+
+
+
+
+########################################
+######## BOOTSTRAP ########
+########################################
+
+
+#x, axis = x, 0
+def se_mean(x, axis=0):
+    """
+    Standard error of the mean along axis, default se of bootstrap_ci studentized.
+    """
+
+    return np.std(x, axis=axis, ddof=1) / np.sqrt(x.shape[axis])
+
+
+
+#x, index, statistic = x, boot_index, np.mean
+def get_resample_statistic(x, index, statistic, mem_budget=256e6):
+    """
+    statistic(x[index[i]], axis=0) for every row of index (n_resample, n_sample), x (n_sample, feature...).
+    Rows are gathered by chunks of at most mem_budget bytes. Returns (n_resample, feature...).
+    """
+
+    n_resample, n_sample = index.shape
+    n_chunk = int(np.clip(mem_budget // (n_sample * x[0].size * x.itemsize), 1, n_resample))
+
+    resample_stat = np.zeros((n_resample,) + x.shape[1:])
+
+    for chunk_start in range(0, n_resample, n_chunk):
+
+        chunk_stop = min(chunk_start + n_chunk, n_resample)
+        resample_stat[chunk_start:chunk_stop] = statistic(x[index[chunk_start:chunk_stop]], axis=1)
+
+    return resample_stat
+
+
+
+#values_sorted, q = np.sort(boot_stat, axis=0), alpha_low
+def quantile_sorted(values_sorted, q):
+    """
+    Linear interpolation quantile (np.percentile default) of values_sorted along axis 0, with one q per feature.
+    """
+
+    pos = np.broadcast_to(q, values_sorted.shape[1:]) * (values_sorted.shape[0] - 1)
+    pos_low = np.clip(np.floor(pos).astype('int'), 0, values_sorted.shape[0] - 1)
+    pos_high = np.minimum(pos_low + 1, values_sorted.shape[0] - 1)
+
+    value_low = np.take_along_axis(values_sorted, pos_low[np.newaxis], axis=0)[0]
+    value_high = np.take_along_axis(values_sorted, pos_high[np.newaxis], axis=0)[0]
+
+    return value_low + (pos - pos_low) * (value_high - value_low)
+
+
+
+#x, statistic, axis = data, np.mean, 0
+def bootstrap_ci(x, statistic=np.mean, axis=0, confidence=0.95, method='bca', n_boot=9999, se=se_mean, seed=None, mem_budget=256e6):
+    """
+    Bootstrap confidence interval of statistic along axis for every other feature of x at once, complement of confidence_interval.
+    ------------
+    Inputs =
+    - statistic : vectorized, statistic(x, axis=...) like np.mean, np.median
+    - method : 'percentile', 'bca' (bias corrected and accelerated, jackknife acceleration) or 'studentized' (bootstrap-t)
+    - se : standard error of statistic, se(x, axis=...), only for 'studentized' (se_mean by default)
+    - the (n_boot, n_sample) resample index matrix is drawn once, statistics are computed by chunks of mem_budget bytes
+
+    Output =
+    - ci_low, ci_high with the shape of x without axis
+    """
+
+    x = np.moveaxis(np.asarray(x, dtype='float'), axis, 0)
+    n_sample = x.shape[0]
+    alpha = (1 - confidence) / 2
+
+    rng = np.random.default_rng(seed)
+    boot_index = rng.integers(0, n_sample, size=(n_boot, n_sample))
+
+    stat_obs = statistic(x, axis=0)
+    boot_stat = get_resample_statistic(x, boot_index, statistic, mem_budget=mem_budget)
+
+    if method == 'percentile':
+
+        boot_sorted = np.sort(boot_stat, axis=0)
+        ci_low, ci_high = quantile_sorted(boot_sorted, alpha), quantile_sorted(boot_sorted, 1 - alpha)
+
+    elif method == 'bca':
+
+        #### bias from the rank of the observed statistic, ties count half
+        prop_below = (np.sum(boot_stat < stat_obs, axis=0) + np.sum(boot_stat <= stat_obs, axis=0)) / (2 * n_boot)
+        z0 = scipy.stats.norm.ppf(prop_below)
+
+        #### acceleration from the jackknife, leave one out index matrix (n_sample, n_sample-1)
+        jack_index = np.arange(1, n_sample) - np.tri(n_sample, n_sample-1, k=-1, dtype='int')
+        jack_stat = get_resample_statistic(x, jack_index, statistic, mem_budget=mem_budget)
+        jack_dev = jack_stat.mean(axis=0) - jack_stat
+        with np.errstate(divide='ignore', invalid='ignore'):
+            accel = np.sum(jack_dev**3, axis=0) / (6 * np.sum(jack_dev**2, axis=0)**1.5)
+
+        boot_sorted = np.sort(boot_stat, axis=0)
+        ci = []
+        for z_alpha in scipy.stats.norm.ppf([alpha, 1 - alpha]):
+            q = scipy.stats.norm.cdf(z0 + (z0 + z_alpha) / (1 - accel * (z0 + z_alpha)))
+            ci.append(quantile_sorted(boot_sorted, np.nan_to_num(q, nan=0.5)))
+        ci_low, ci_high = ci
+
+    elif method == 'studentized':
+
+        se_obs = se(x, axis=0)
+        boot_se = get_resample_statistic(x, boot_index, se, mem_budget=mem_budget)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            boot_t = np.sort((boot_stat - stat_obs) / boot_se, axis=0)
+        ci_low = stat_obs - quantile_sorted(boot_t, 1 - alpha) * se_obs
+        ci_high = stat_obs - quantile_sorted(boot_t, alpha) * se_obs
+
+    else:
+        raise ValueError(f"method must be 'percentile', 'bca' or 'studentized', not {method}")
+
+    return ci_low, ci_high
+
+
+
+
+########################################
+######## DISPATCH ########
+########################################
+
+
+#da, test = da, 'ttest_paired'
+def mass_univariate_stats(da, test, cond_A=None, cond_B=None, correction='fdr', subject_dim='subject', cond_dim='cond', **kwargs):
+    """
+    Array-native counterpart of auto_stats for (subject, cond, feature...) tensors.
+    test : 'ttest_paired', 'ttest_ind', 'wilcoxon' (need cond_A, cond_B), 'rm_anova', 'friedman' (all cond).
+    Returns an xr.Dataset (stat, pval, pval_corr, ...) aligned with the feature dims of da.
+    """
+
+    if test == 'ttest_paired':
+        return ttest_paired_mass(da, cond_A, cond_B, correction=correction, subject_dim=subject_dim, cond_dim=cond_dim)
+    elif test == 'ttest_ind':
+        return ttest_ind_mass(da, cond_A, cond_B, correction=correction, subject_dim=subject_dim, cond_dim=cond_dim, **kwargs)
+    elif test == 'wilcoxon':
+        return wilcoxon_mass(da, cond_A, cond_B, correction=correction, subject_dim=subject_dim, cond_dim=cond_dim, **kwargs)
+    elif test == 'rm_anova':
+        return rm_anova_mass(da, correction=correction, subject_dim=subject_dim, cond_dim=cond_dim)
+    elif test == 'friedman':
+        return friedman_mass(da, correction=correction, subject_dim=subject_dim, cond_dim=cond_dim)
+    else:
+        raise ValueError(f'unknown test {test}')
+
+
@@ -1,19 +1,146 @@
 
 import os
 from n00_config_params import *
+from n00quater_robust_stats import *
+from n00quinquies_mass_univariate_stats import *
 import numpy as np
 import pandas as pd
 import pingouin as pg
 import seaborn as sns
 from statannotations.Annotator import Annotator
 import matplotlib.pyplot as plt
+import scipy
 from scipy import stats
 import itertools
+import hashlib
+import pickle
+import io
+import contextlib
+import inspect
+import functools
+from concurrent.futures import ProcessPoolExecutor
 import statsmodels.formula.api as smf
+import statsmodels.api as sm
+import warnings
+import sys
 
 def mad(data, constant = 1.4826):
-    median = np.median(data)
-    return np.median(np.abs(data - median)) * constant
+    median, _mad = median_mad(data, constant=constant)
+    return _mad
+
+def get_stats_code_id(fun, dep_list):
+    # sources of the cached helper, of the stats callees it depends on (dep_list, names in this module), of the robust and
+    # mass univariate stats modules, and versions of the stats libraries : any change invalidates the helper results,
+    # plotting code is left out so a cosmetic figure edit keeps them
+    source_list = [inspect.getsource(fun)] + [inspect.getsource(fun.__globals__[dep]) for dep in dep_list]
+    for module in ['n00quater_robust_stats', 'n00quinquies_mass_univariate_stats']:
+        with open(sys.modules[module].__file__) as f:
+            source_list.append(f.read())
+    version_list = [np.__version__, pd.__version__, scipy.__version__, pg.__version__, sm.__version__]
+    return hashlib.sha1('|'.join(source_list + version_list).encode()).hexdigest()
+
+def get_arg_hash(arg_value):
+    # content hash of dataframes, series and arrays (repr truncates them), repr of everything else
+    if isinstance(arg_value, (pd.DataFrame, pd.Series)):
+        arg_hash = hashlib.sha1(pd.util.hash_pandas_object(arg_value, index=True).values.tobytes()).hexdigest()
+        if isinstance(arg_value, pd.DataFrame):
+            return f'{arg_hash}{list(arg_value.columns)}{list(arg_value.dtypes.astype(str))}'
+        return f'{arg_hash}{arg_value.name!r}{arg_value.dtype}'
+    if isinstance(arg_value, np.ndarray):
+        arg_bytes = pickle.dumps(arg_value.tolist()) if arg_value.dtype.hasobject else np.ascontiguousarray(arg_value).tobytes()
+        return f'{hashlib.sha1(arg_bytes).hexdigest()}{arg_value.shape}{arg_value.dtype}'
+    return repr(arg_value)
+
+def get_stats_cache_key(fun, fun_id, args, kwargs):
+    # stable hash of the stats code and of every argument, dataframes, series and arrays by content
+    bound = inspect.signature(fun).bind(*args, **kwargs)
+    bound.apply_defaults()
+    key_list = [fun.__name__, fun_id]
+    for arg_name, arg_value in bound.arguments.items():
+        key_list.append(f'{arg_name}={get_arg_hash(arg_value)}')
+    return hashlib.sha1('|'.join(key_list).encode()).hexdigest()
+
+def evict_stats_cache(max_size=stats_cache_max_size):
+    # remove the least recently used results until the cache fits in max_size bytes
+    # pool workers evict concurrently, files already removed by another process are skipped
+    file_stat_list = []
+    for file in os.listdir(path_stats_cache):
+        if not file.endswith('.pkl'):
+            continue
+        try:
+            file_stat = os.stat(os.path.join(path_stats_cache, file))
+        except FileNotFoundError:
+            continue
+        file_stat_list.append((file_stat.st_mtime, file_stat.st_size, os.path.join(path_stats_cache, file)))
+    cache_size = sum(file_size for _, file_size, _ in file_stat_list)
+    for _, file_size, file in sorted(file_stat_list):
+        if cache_size <= max_size:
+            break
+        cache_size -= file_size
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+def call_capture_stdout(fun, args, kwargs):
+    # run fun printing as usual, and return what it printed so cache hits can print it again
+    stdout = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout):
+            res = fun(*args, **kwargs)
+    finally:
+        sys.stdout.write(stdout.getvalue())
+    return res, stdout.getvalue()
+
+stats_cache_n_write = 0
+
+def stats_disk_cache(dep_list=()):
+    # on disk memoization of a stats helper, keyed by get_stats_cache_key, use_cache=False to recompute
+    # dep_list : names of the stats functions of this module the helper calls (directly or not), hashed with its source
+    # the printed output is stored with the result and printed again on a hit, changes to the arguments are not replayed
+    def decorator(fun):
+        fun_id = None
+        @functools.wraps(fun)
+        def fun_cached(*args, use_cache=True, **kwargs):
+            nonlocal fun_id
+            global stats_cache_n_write
+            if not use_cache:
+                return fun(*args, **kwargs)
+            # callees may be defined after the helper, sources are read on the first call
+            if fun_id is None:
+                try:
+                    fun_id = get_stats_code_id(fun, dep_list)
+                except (OSError, TypeError, KeyError):
+                    fun_id = f'{fun.__qualname__}{list(dep_list)}'
+            path_file = os.path.join(path_stats_cache, f'{fun.__name__}_{get_stats_cache_key(fun, fun_id, args, kwargs)}.pkl')
+            try:
+                os.utime(path_file)
+                with open(path_file, 'rb') as f:
+                    res, printed = pickle.load(f)
+                sys.stdout.write(printed)
+                return res
+            except FileNotFoundError:
+                pass
+            res, printed = call_capture_stdout(fun, args, kwargs)
+            os.makedirs(path_stats_cache, exist_ok=True)
+            path_tmp = f'{path_file}.{os.getpid()}.tmp'
+            try:
+                with open(path_tmp, 'wb') as f:
+                    pickle.dump((res, printed), f)
+                os.replace(path_tmp, path_file)
+            finally:
+                # only left when the dump failed, eviction never sees tmp files
+                if os.path.exists(path_tmp):
+                    os.remove(path_tmp)
+            # scan for eviction on the first write of the process, then every stats_cache_evict_every writes
+            if stats_cache_n_write % stats_cache_evict_every == 0:
+                evict_stats_cache()
+            stats_cache_n_write += 1
+            return res
+        return fun_cached
+    return decorator
+
+stats_cache_perm_deps = ['permutation', 'permutation_test_homemade', 'permutation_test_batch', 'permutation_test_exact_paired', 'get_sign_flip_matrix', 'mean_diff_statistic']
 
 def normality(df, predictor, outcome):
     df = df.reset_index(drop=True)
@@ -39,6 +166,7 @@ def homoscedasticity(df, predictor, outcome):
 
     return homoscedasticity
 
+@stats_disk_cache(['normality', 'homoscedasticity', 'sphericity'])
 def parametric(df, predictor, outcome, subject = None):
     
     df = df.reset_index(drop=True)
@@ -89,6 +217,7 @@ def guidelines(df, predictor, outcome, design, parametricity):
                 
     return tests
 
+@stats_disk_cache(['es_interpretation'])
 def pg_compute_pre(df, predictor, outcome, test, subject=None, show = False):
     
     pval_labels = {'t-test_ind':'p-val','t-test_paired':'p-val','anova':'p-unc','rm_anova':'p-unc','Mann-Whitney':'p-val','Wilcoxon':'p-val', 'Kruskal':'p-unc', 'friedman':'p-unc'}
@@ -197,6 +326,7 @@ def homemade_post_hoc(df, predictor, outcome, design = 'within', subject = None,
     return pairs
         
 #test = post_test
+@stats_disk_cache(stats_cache_perm_deps)
 def pg_compute_post_hoc(df, predictor, outcome, test, subject=None):
 
     if not subject is None:
@@ -572,24 +702,75 @@ def qqplot(df, predictor, outcome, figsize = (10,15)):
         
     plt.show()
 
-def permutation_test_homemade(x,y, design = 'within', n_resamples=999):
-    def statistic(x, y):
-        return np.mean(x) - np.mean(y)
+sign_flip_matrix_cache = {}
+
+def get_sign_flip_matrix(n):
+    # all the 2**n sign flips of n paired differences (2**n, n), row 0 is the observed assignment
+    if n not in sign_flip_matrix_cache:
+        sign_flip_matrix_cache[n] = (1 - 2 * ((np.arange(2**n).reshape(-1,1) >> np.arange(n)) & 1)).astype('float')
+    return sign_flip_matrix_cache[n]
+
+def permutation_test_exact_paired(diff):
+    # exact two-sided p-value of mean(diff) over every sign flip, one matrix product, diff (n,) or (n, n_test)
+    diff = np.asarray(diff, dtype='float')
+    null_stat = get_sign_flip_matrix(diff.shape[0]) @ diff / diff.shape[0]
+    return np.mean(np.abs(null_stat) >= np.abs(diff.mean(axis=0)) * (1 - 1e-14), axis=0)
+
+def mean_diff_statistic(x, y, axis=0):
+    return np.mean(x, axis=axis) - np.mean(y, axis=axis)
+
+def permutation_test_batch(x, y, design = 'within', n_resamples=999, exact_max_n=14, mem_budget=perm_mem_budget):
+    # x, y (n, n_test) : one scipy permutation_test call for every column with a vectorized statistic,
+    # resamples by batches bounded by mem_budget, exact sign flips for small paired designs
+    x, y = np.asarray(x, dtype='float'), np.asarray(y, dtype='float')
+    if design == 'within' and x.shape[0] <= exact_max_n:
+        return permutation_test_exact_paired(x - y)
     if design == 'within':
         permutation_type = 'samples'
     elif design == 'between':
         permutation_type = 'independent'
-    res = stats.permutation_test(data=[x,y], statistic=statistic, permutation_type=permutation_type, n_resamples=n_resamples, batch=None, alternative='two-sided', axis=0, random_state=None)
-    return res.pvalue
+    # a few (batch, n, n_test) float arrays alive per vectorized call
+    batch = int(max(1, mem_budget // (4 * (x.size + y.size) * 8)))
+    res = stats.permutation_test(data=[x,y], statistic=mean_diff_statistic, permutation_type=permutation_type, vectorized=True, n_resamples=n_resamples, batch=batch, alternative='two-sided', axis=0, random_state=None)
+    return np.atleast_1d(res.pvalue)
 
-def permutation(df, predictor, outcome , design = 'within' , subject = None, n_resamples=999):
+def permutation_test_homemade(x,y, design = 'within', n_resamples=999, sequential=False, alpha=0.05, error=1e-3, exact_max_n=14):
+    def statistic(x, y):
+        return np.mean(x) - np.mean(y)
+    x, y = np.asarray(x, dtype='float'), np.asarray(y, dtype='float')
+    # exact sign flips for small paired designs, sequential or not
+    if design == 'within' and x.size <= exact_max_n:
+        return float(permutation_test_exact_paired(x - y))
+    if sequential:
+        # stops as soon as p < alpha is settled at error (Clopper-Pearson), two-sided on |mean(x) - mean(y)|
+        # seeded from the global state so np.random.seed keeps it reproducible, like the scipy path
+        rng = np.random.default_rng(np.random.randint(2**31))
+        def draw_null(n):
+            if design == 'within':
+                diff = x - y
+                return (rng.choice([-1., 1.], size=(n, diff.size)) @ diff) / diff.size
+            elif design == 'between':
+                pooled = rng.permuted(np.tile(np.concatenate((x, y)), (n, 1)), axis=1)
+                return pooled[:, :x.size].mean(axis=1) - pooled[:, x.size:].mean(axis=1)
+        return sequential_permutation_pvalue(draw_null, statistic(x, y), n_resamples=n_resamples, alpha=alpha, error=error)[0]
+    return permutation_test_batch(np.reshape(x, (-1,1)), np.reshape(y, (-1,1)), design=design, n_resamples=n_resamples, exact_max_n=exact_max_n)[0]
+
+def permutation(df, predictor, outcome , design = 'within' , subject = None, n_resamples=999, sequential=False):
     pairs = list((itertools.combinations(df[predictor].unique(), 2)))
-    pvals = []
-    for pair in pairs:
-        x = df[df[predictor] == pair[0]][outcome].values
-        y = df[df[predictor] == pair[1]][outcome].values
-        p = permutation_test_homemade(x=x,y=y, design=design, n_resamples=n_resamples)
-        pvals.append(p)
+    values = {cond : df[df[predictor] == cond][outcome].values for cond in df[predictor].unique()}
+    if sequential:
+        pvals = [permutation_test_homemade(x=values[A], y=values[B], design=design, n_resamples=n_resamples, sequential=True) for A, B in pairs]
+    else:
+        # every pair with the same group sizes in one stacked call
+        pvals = np.zeros(len(pairs))
+        pairs_by_size = {}
+        for pair_i, (A, B) in enumerate(pairs):
+            pairs_by_size.setdefault((values[A].size, values[B].size), []).append(pair_i)
+        for pair_sel in pairs_by_size.values():
+            x = np.stack([values[pairs[pair_i][0]] for pair_i in pair_sel], axis=1)
+            y = np.stack([values[pairs[pair_i][1]] for pair_i in pair_sel], axis=1)
+            pvals[pair_sel] = permutation_test_batch(x=x, y=y, design=design, n_resamples=n_resamples)
+        pvals = list(pvals)
     df_return = pd.DataFrame(pairs, columns = ['A','B'])
     df_return['p-unc'] = pvals
     rej , pcorrs = pg.multicomp(pvals, method = 'holm')
@@ -603,8 +784,7 @@ def reorder_df(df, colname, order):
     return pd.concat(concat)
 
 
-def lmm(df, predictor, outcome, subject, order=None):
-
+def get_lmm_formula(predictor, outcome):
     if isinstance(predictor, str):
         formula = f'{outcome} ~ {predictor}' 
     elif isinstance(predictor, list):
@@ -612,6 +792,11 @@ def lmm(df, predictor, outcome, subject, order=None):
             formula = f'{outcome} ~ {predictor[0]}*{predictor[1]}' 
         elif len(predictor) == 3:
             formula = f'{outcome} ~ {predictor[0]}*{predictor[1]}*{predictor[2]}' 
+    return formula
+
+def lmm(df, predictor, outcome, subject, order=None):
+
+    formula = get_lmm_formula(predictor, outcome)
 
     if not order is None:
         df = reorder_df(df, predictor, order)
@@ -647,6 +832,53 @@ def lmm(df, predictor, outcome, subject, order=None):
     return mdf
 
 
+def get_lmm_start_params(df, formula, subject):
+    # fixed effects from the pooled ols fit, random intercept variance (relative to scale) from its residuals
+    ols = smf.ols(formula, data=df).fit()
+    resid = ols.resid
+    resid_subject = resid.groupby(df.loc[resid.index, subject]).transform('mean')
+    var_within = np.var(resid - resid_subject, ddof=1)
+    var_subject = max(np.var(resid_subject, ddof=1), 1e-3 * var_within)
+    return sm.regression.mixed_linear_model.MixedLMParams.from_components(fe_params=ols.params.values, cov_re=np.array([[var_subject / var_within]]))
+
+def lmm_fit(df, formula, subject, outcome=None):
+    # one mixedlm fit without print nor plot, tidy table of fixed effects with convergence diagnostics
+    df = df.dropna(subset=[outcome]) if outcome is not None else df
+    with warnings.catch_warnings(record=True) as warning_list:
+        warnings.simplefilter('always')
+        try:
+            md = smf.mixedlm(formula, data=df, groups=df[subject])
+            mdf = md.fit(start_params=get_lmm_start_params(df, formula, subject))
+        except Exception as error:
+            return pd.DataFrame({'outcome' : [outcome], 'formula' : [formula], 'term' : [None], 'converged' : [False], 'error' : [repr(error)]})
+    ci = mdf.conf_int()
+    df_res = pd.DataFrame({'term' : mdf.params.index, 'coef' : mdf.params.values, 'se' : mdf.bse.values, 'z' : mdf.tvalues.values, 
+                           'pval' : mdf.pvalues.values, 'ci_low' : ci[0].values, 'ci_high' : ci[1].values})
+    df_res.insert(0, 'formula', formula)
+    df_res.insert(0, 'outcome', outcome)
+    df_res['converged'] = mdf.converged
+    df_res['n_warnings'] = len(warning_list)
+    df_res['warnings'] = '; '.join(sorted(set(str(warning.message) for warning in warning_list)))
+    df_res['llf'] = mdf.llf
+    df_res['n_obs'] = mdf.nobs
+    df_res['n_groups'] = len(mdf.model.group_labels)
+    df_res['error'] = None
+    return df_res
+
+def lmm_outcome_list(df, predictor, outcome_list, subject, formula=None, n_jobs=n_core):
+    # lmm over many outcomes in a process pool, no plot, one tidy table
+    # formula : template with {outcome}, default from predictor like lmm
+    formula_list = [get_lmm_formula(predictor, outcome) if formula is None else formula.format(outcome=outcome) for outcome in outcome_list]
+    n_jobs = min(n_jobs, len(outcome_list))
+    args = ([df]*len(outcome_list), formula_list, [subject]*len(outcome_list), outcome_list)
+    if n_jobs <= 1:
+        res_list = list(map(lmm_fit, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res_list = list(executor.map(lmm_fit, *args))
+    return pd.concat(res_list).reset_index(drop=True)
+
+
 def confidence_interval(x, confidence = 0.95, verbose = False):
     m = x.mean() 
     s = x.std() 
@@ -734,6 +966,7 @@ def pg_compute_pre_full_res(df, predictor, outcome, test, subject=None, show = F
     return res
 
 
+@stats_disk_cache(['parametric', 'normality', 'homoscedasticity', 'sphericity', 'transform_data', 'guidelines', 'pg_compute_pre_full_res', 'es_interpretation', 'pg_compute_post_hoc'] + stats_cache_perm_deps)
 def get_df_stats_pre(df, predictor, outcome, subject=None, design='within', transform=False, verbose=True):
 
     if isinstance(predictor, str):
@@ -779,10 +1012,86 @@ def get_df_stats_pre(df, predictor, outcome, subject=None, design='within', tran
     return results
 
 
+def get_group_descriptives(df, predictor, outcome):
+    # every per group descriptive of get_summary_stats in one groupby pass, indexed by group
+    groupby = df.groupby(predictor, sort=False)[outcome]
+    df_desc = groupby.agg(['size', 'mean', 'std', 'median'])
+    df_desc.columns = ['N', 'mean', 'std', 'median']
+    df_desc['mad'] = (df[outcome] - groupby.transform('median')).abs().groupby(df[predictor], sort=False).median()
+    df_quantiles = groupby.quantile([0.25, 0.75]).unstack()
+    df_desc['Q1'], df_desc['Q3'] = df_quantiles[0.25], df_quantiles[0.75]
+    # as stats.median_abs_deviation and np.percentile did, nan in a group gives nan mad and quartiles (mean, std, median skip nan)
+    has_nan = df[outcome].isna().groupby(df[predictor], sort=False).any().reindex(df_desc.index)
+    df_desc.loc[has_nan, ['mad', 'Q1', 'Q3']] = np.nan
+    return df_desc
+
+def get_data_hash(df, columns):
+    return hashlib.sha1(pd.util.hash_pandas_object(df[columns], index=False).values.tobytes()).hexdigest()
+
+param_check_cache = {}
+
+def get_parametricity(df, predictor, outcome):
+    # normality (groups or ols residuals) and homoscedasticity checks, cached by (outcome, predictor, data hash)
+    predictor_list = [predictor] if isinstance(predictor, str) else list(predictor)
+    cache_key = (outcome, tuple(predictor_list), get_data_hash(df, [outcome] + predictor_list))
+
+    if cache_key in param_check_cache:
+        df_parametricity, parametricity = param_check_cache[cache_key]
+        return df_parametricity.copy(), parametricity
+
+    if isinstance(predictor, str) and df[predictor].unique().size <= 2:
+
+        #### identify normality of every groups
+        df_parametricity = pg.normality(data=df, dv=outcome, group=predictor, method='normaltest') # Shapiro Wilk
+        df_parametricity.insert(0, 'param_test', ['shapiro_wilk']*df_parametricity.shape[0], True)
+        
+        if sum(df_parametricity['normal']) == df_parametricity['normal'].size:
+            parametricity = True
+        else:
+            parametricity = False
+
+    else:
+
+        #### 1) identify normality of residuals
+        if isinstance(predictor, str):
+            formula = f'{outcome} ~ {predictor}'
+            group = df[predictor]
+        else:
+            formula = f'{outcome} ~ {predictor[0]} + {predictor[1]} + {predictor[0]}:{predictor[1]}'
+            group = df[predictor[0]] + df[predictor[1]]
+
+        model = smf.ols(formula, data=df).fit()
+        residuals = model.resid
+        df_parametricity = pg.normality(residuals, method='normaltest') # Shapiro Wilk
+        df_parametricity.insert(0, 'param_test', ['shapiro']*df_parametricity.shape[0], True)
+        df_parametricity = df_parametricity.rename(columns={'normal' : 'parametric'})
+
+        #### 2) identify homoscedasticity
+        _df_parametricity = pg.homoscedasticity(data=pd.DataFrame({outcome : df[outcome].values, 'group' : group.values}), dv=outcome, group='group', method='levene').reset_index(drop=True) # Levene test
+        _df_parametricity.insert(0, 'param_test', ['levene']*df_parametricity.shape[0], True)
+        _df_parametricity = _df_parametricity.rename(columns={'equal_var' : 'parametric'})
+
+        df_parametricity = pd.concat([df_parametricity, _df_parametricity])
+
+        #### 3) idependance, to check on the protocol
+
+        #### Final decision
+
+        if sum(df_parametricity['parametric']) == 2:
+            parametricity = True
+        else:
+            parametricity = False 
+
+    param_check_cache[cache_key] = (df_parametricity.copy(), parametricity)
+
+    return df_parametricity, parametricity
+
+
 # df = load_respi_stat_df()
 # df = load_respi_stat_df().query(f"cond == 'MECA'")
 #df, predictor, outcome, subject, design, transform, verbose, export_param_test =  df, 'session', 'BF', 'sujet', 'within', False
-def get_summary_stats(df, predictor, outcome, subject=None, design='within', export_param_test=False):
+@stats_disk_cache(['get_parametricity', 'get_data_hash', 'get_group_descriptives', 'guidelines', 'pg_compute_post_hoc'] + stats_cache_perm_deps)
+def compute_summary_stats(df, predictor, outcome, subject=None, design='within', export_param_test=False):
 
     #### one independant variable
 
@@ -798,45 +1107,7 @@ def get_summary_stats(df, predictor, outcome, subject=None, design='within', exp
 
         #### parametricity
 
-        n_group = df[predictor].unique().size
-
-        if n_group <= 2:
-
-            #### identify normality of every groups
-            df_parametricity = pg.normality(data=df, dv=outcome, group=predictor, method='normaltest') # Shapiro Wilk
-            df_parametricity.insert(0, 'param_test', ['shapiro_wilk']*df_parametricity.shape[0], True)
-            
-            if sum(df_parametricity['normal']) == df_parametricity['normal'].size:
-                parametricity = True
-            else:
-                parametricity = False
-
-        if n_group > 2:
-
-            #### 1) identify normality of residuals
-            formula = f'{outcome} ~ {predictor}'
-
-            model = smf.ols(formula, data=df).fit()
-            residuals = model.resid
-            df_parametricity = pg.normality(residuals, method='normaltest') # Shapiro Wilk
-            df_parametricity.insert(0, 'param_test', ['shapiro']*df_parametricity.shape[0], True)
-            df_parametricity = df_parametricity.rename(columns={'normal' : 'parametric'})
-
-            #### 2) identify homoscedasticity
-            _df_parametricity = pg.homoscedasticity(data=df, dv=outcome, group=predictor, method='levene').reset_index(drop=True) # Levene test
-            _df_parametricity.insert(0, 'param_test', ['levene']*df_parametricity.shape[0], True)
-            _df_parametricity = _df_parametricity.rename(columns={'equal_var' : 'parametric'})
-
-            df_parametricity = pd.concat([df_parametricity, _df_parametricity])
-
-            #### 3) idependance, to check on the protocol
-
-            #### Final decision
-
-            if sum(df_parametricity['parametric']) == 2:
-                parametricity = True
-            else:
-                parametricity = False 
+        df_parametricity, parametricity = get_parametricity(df, predictor, outcome)
         
         # parametricity_pre_transfo = parametric(df, predictor, outcome, subject)
         
@@ -906,11 +1177,14 @@ def get_summary_stats(df, predictor, outcome, subject=None, design='within', exp
                 pval = np.round(res['p-val'].values[0], 5)
                 cohen_d = None
 
+            df_desc = get_group_descriptives(df, predictor, outcome)
+            desc_A, desc_B = df_desc.loc[groups[0]], df_desc.loc[groups[1]]
+
             stats_descriptives = {'A' : [groups[0]], 'B' : [groups[1]], 
-                        'A_N' : [A_data.size], 'B_N' : [B_data.size],           
-                        'mean(A)' : [A_data.mean()], 'std(A)' : [A_data.std()], 'mean(B)' : [B_data.mean()], 'std(B)' : [B_data.std()],
-                        'median(A)' : [A_data.median()], 'mad(A)' : [stats.median_abs_deviation(A_data)], 'A_Q1' : [np.percentile(A_data, 25)], 'A_Q3' : [np.percentile(A_data, 75)], 
-                        'median(B)' : [B_data.median()], 'mad(B)' : [stats.median_abs_deviation(B_data)], 'B_Q1' : [np.percentile(B_data, 25)], 'B_Q3' : [np.percentile(B_data, 75)]}
+                        'A_N' : [desc_A['N']], 'B_N' : [desc_B['N']],           
+                        'mean(A)' : [desc_A['mean']], 'std(A)' : [desc_A['std']], 'mean(B)' : [desc_B['mean']], 'std(B)' : [desc_B['std']],
+                        'median(A)' : [desc_A['median']], 'mad(A)' : [desc_A['mad']], 'A_Q1' : [desc_A['Q1']], 'A_Q3' : [desc_A['Q3']], 
+                        'median(B)' : [desc_B['median']], 'mad(B)' : [desc_B['mad']], 'B_Q1' : [desc_B['Q1']], 'B_Q3' : [desc_B['Q3']]}
             
             res['predictor'] = predictor
             res['outcome'] = outcome
@@ -976,15 +1250,12 @@ def get_summary_stats(df, predictor, outcome, subject=None, design='within', exp
 
             df_post_hoc = post_hoc.reindex(columns=['predictor', 'outcome', 'param', 'pre_test_name', 'stat_test', 'alternative', 'pre_pval', 'cohen_d', 'post_test_name', 'A', 'B', 'mean(A)', 'std(A)', 'mean(B)', 'std(B)', 'p-unc', 'p-corr', 'p-adjust'])
 
-            _dict_median = {'median(A)' : [], 'median(B)' : [], 'mad(A)' : [], 'mad(B)' : [], 'A_Q1' : [], 'B_Q1' : [], 'A_Q3' : [], 'B_Q3' : [], 'A_N' : [], 'B_N' : []}
+            #### descriptives of A and B rows from one groupby pass
+            df_desc = get_group_descriptives(df, predictor, outcome)
+            desc_A, desc_B = df_desc.loc[df_post_hoc['A'].values].reset_index(drop=True), df_desc.loc[df_post_hoc['B'].values].reset_index(drop=True)
 
-            for row_i in range(df_post_hoc.shape[0]):
-                A_data, B_data = df[df[predictor] == df_post_hoc.iloc[row_i,:]['A']][outcome], df[df[predictor] == df_post_hoc.iloc[row_i,:]['B']][outcome]
-                A_median, B_median, A_mad, B_mad = A_data.median(), B_data.median(), stats.median_abs_deviation(A_data), stats.median_abs_deviation(B_data)
-                A_Q1, B_Q1, A_Q3, B_Q3 = np.percentile(A_data, 25), np.percentile(B_data, 25), np.percentile(A_data, 75), np.percentile(B_data, 75)
-                _dict_median['median(A)'].append(A_median), _dict_median['median(B)'].append(B_median), _dict_median['mad(A)'].append(A_mad), _dict_median['mad(B)'].append(B_mad)
-                _dict_median['A_Q1'].append(A_Q1), _dict_median['B_Q1'].append(B_Q1), _dict_median['A_Q3'].append(A_Q3), _dict_median['B_Q3'].append(B_Q3)
-                _dict_median['A_N'].append(A_data.size), _dict_median['B_N'].append(B_data.size)
+            _dict_median = {'median(A)' : desc_A['median'], 'median(B)' : desc_B['median'], 'mad(A)' : desc_A['mad'], 'mad(B)' : desc_B['mad'], 
+                            'A_Q1' : desc_A['Q1'], 'B_Q1' : desc_B['Q1'], 'A_Q3' : desc_A['Q3'], 'B_Q3' : desc_B['Q3'], 'A_N' : desc_A['N'], 'B_N' : desc_B['N']}
 
             df_median = pd.DataFrame(_dict_median)
             df_post_hoc = pd.concat([df_post_hoc, df_median], axis=1)
@@ -1001,34 +1272,9 @@ def get_summary_stats(df, predictor, outcome, subject=None, design='within', exp
 
     elif isinstance(predictor, list):
 
-        #### parametricity
-
-        #### 1) identify normality of residuals
-        formula = f'{outcome} ~ {predictor[0]} + {predictor[1]} + {predictor[0]}:{predictor[1]}'
-
-        model = smf.ols(formula, data=df).fit()
-        residuals = model.resid
-        df_parametricity = pg.normality(residuals, method='normaltest') # Shapiro Wilk
-        df_parametricity.insert(0, 'param_test', ['shapiro']*df_parametricity.shape[0], True)
-        df_parametricity = df_parametricity.rename(columns={'normal' : 'parametric'})
-
-        #### 2) identify homoscedasticity
-        df['interaction'] = df[predictor[0]] + df[predictor[1]]
+        #### parametricity, df['interaction'] added by get_summary_stats
 
-        _df_parametricity = pg.homoscedasticity(data=df, dv=outcome, group='interaction', method='levene').reset_index(drop=True)
-        _df_parametricity.insert(0, 'param_test', ['levene']*df_parametricity.shape[0], True)
-        _df_parametricity = _df_parametricity.rename(columns={'equal_var' : 'parametric'})
-
-        df_parametricity = pd.concat([df_parametricity, _df_parametricity])
-
-        #### 3) idependance, to check on the protocol
-
-        #### Final decision
-
-        if sum(df_parametricity['parametric']) == 2:
-            parametricity = True
-        else:
-            parametricity = False 
+        df_parametricity, parametricity = get_parametricity(df, predictor, outcome)
 
         if parametricity == False:
             print(df_parametricity)
@@ -1058,47 +1304,59 @@ def get_summary_stats(df, predictor, outcome, subject=None, design='within', exp
 
 
 
-def load_respi_stat_df():
-
-    os.chdir(os.path.join(path_data, 'respi_detection'))
-    df_respi_paris = pd.read_excel('OLFADYS_alldata_mean.xlsx').query(f"sujet in {sujet_list.tolist()}").reset_index(drop=True)
-
-    for row_i in range(df_respi_paris.shape[0]):
-        if df_respi_paris.iloc[row_i]['odor'] == 'p':
-            df_respi_paris['odor'][row_i] = '+'
-        if df_respi_paris.iloc[row_i]['odor'] == 'n':
-            df_respi_paris['odor'][row_i] = '-'
-
-    df_respi_paris = df_respi_paris.rename(columns={"odor": "session"})
-
-    sujet_sel_mask = []
+def get_summary_stats(df, predictor, outcome, subject=None, design='within', export_param_test=False, use_cache=True):
+    # cached compute_summary_stats, the interaction column of two predictors is added to the caller df on a cache hit too
+    if isinstance(predictor, list):
+        df['interaction'] = df[predictor[0]] + df[predictor[1]]
+    return compute_summary_stats(df, predictor, outcome, subject=subject, design=design, export_param_test=export_param_test, use_cache=use_cache)
 
-    for row_i in range(df_respi_paris.shape[0]):
 
-        if df_respi_paris['sujet'].iloc[row_i] in sujet_best_list_rev:
 
-            sujet_sel_mask.append('YES')
+def get_summary_stats_outcome_list(df, predictor, outcome_list, subject=None, design='within', export_param_test=False, n_jobs=n_core):
+    # get_summary_stats for many outcomes in a process pool, one concatenated table (and parametricity table)
+    n_jobs = min(n_jobs, len(outcome_list))
+    args = ([df]*len(outcome_list), [predictor]*len(outcome_list), outcome_list, [subject]*len(outcome_list), [design]*len(outcome_list), [True]*len(outcome_list))
+    if n_jobs <= 1:
+        res_list = list(map(get_summary_stats, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res_list = list(executor.map(get_summary_stats, *args))
+    df_res = pd.concat([res[0] for res in res_list]).reset_index(drop=True)
+    if export_param_test:
+        df_parametricity = pd.concat([res[1].assign(outcome=outcome) for outcome, res in zip(outcome_list, res_list)]).reset_index(drop=True)
+        return df_res, df_parametricity
+    else:
+        return df_res
 
-        else:
 
-            sujet_sel_mask.append('NO')
 
-    df_respi_paris['select_best'] = sujet_sel_mask
+def read_excel_cached(path_xlsx, path_cache):
+    # binary (pickle) copy of the excel table, re-parsed only when the xlsx is newer than the copy
+    if os.path.exists(path_cache) and os.path.getmtime(path_cache) >= os.path.getmtime(path_xlsx):
+        return pd.read_pickle(path_cache)
+    df = pd.read_excel(path_xlsx)
+    os.makedirs(os.path.dirname(path_cache), exist_ok=True)
+    path_tmp = f'{path_cache}.{os.getpid()}.tmp'
+    df.to_pickle(path_tmp)
+    os.replace(path_tmp, path_cache)
+    return df
 
-    nan_count = 0
+def load_respi_stat_df():
 
-    for respi_metric in ['TI', 'Te', 'Ttot', 'BF', 'VT', 'Ve', 'VT_Ti', 'Ti_Ttot', 'PRESS', 'PetCO2']:
+    os.chdir(os.path.join(path_data, 'respi_detection'))
+    df_respi_paris = read_excel_cached(os.path.join(path_data, 'respi_detection', 'OLFADYS_alldata_mean.xlsx'), os.path.join(path_precompute, 'OLFADYS_alldata_mean.pkl'))
+    df_respi_paris = df_respi_paris[df_respi_paris['sujet'].isin(list(sujet_list))].reset_index(drop=True)
 
-        for nan_i in np.where(df_respi_paris[respi_metric].isnull().values)[0]:
+    df_respi_paris['odor'] = df_respi_paris['odor'].replace({'p' : '+', 'n' : '-'})
+    df_respi_paris = df_respi_paris.rename(columns={"odor": "session"})
 
-            odor = df_respi_paris['session'][nan_i]
-            cond = df_respi_paris['cond'][nan_i]
-            nan_replace = df_respi_paris.query(f"session == '{odor}' and cond == '{cond}'")[respi_metric].median()
-            df_respi_paris[respi_metric][nan_i] = nan_replace 
+    df_respi_paris['select_best'] = np.where(df_respi_paris['sujet'].isin(list(sujet_best_list_rev)), 'YES', 'NO')
 
-            nan_count += 1
+    #### nan replaced by the session / cond median of the metric
+    respi_metric_list = ['TI', 'Te', 'Ttot', 'BF', 'VT', 'Ve', 'VT_Ti', 'Ti_Ttot', 'PRESS', 'PetCO2']
+    nan_count = int(df_respi_paris[respi_metric_list].isnull().values.sum())
+    df_respi_paris[respi_metric_list] = df_respi_paris[respi_metric_list].fillna(df_respi_paris.groupby(['session', 'cond'])[respi_metric_list].transform('median'))
 
     print(f"{nan_count} replaced")
-    df_respi_paris
 
-    return df_respi_paris
\ No newline at end of file
+    return df_respi_paris
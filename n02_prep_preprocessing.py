@@ -722,8 +722,7 @@ def iirfilt(sig, srate, lowcut=None, highcut=None, order=4, ftype='butter', verb
 
 def med_mad(data, constant = 1.4826):
 
-    median = np.median(data)
-    mad = np.median(np.abs(data - median)) * constant
+    median, mad = median_mad(data, constant=constant)
 
     return median , mad
 
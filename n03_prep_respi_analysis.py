@@ -25,6 +25,39 @@ debug = False
 ########################################
 
 
+#x, starts, stops = derivate1, i0, i1
+def segment_argmin(x, starts, stops):
+    """
+    First argmin of x inside each [starts, stops) segment, relative to starts, in one pass over all segments.
+    Empty segments return 0.
+    """
+
+    starts, stops = np.asarray(starts, dtype='int64'), np.asarray(stops, dtype='int64')
+    lengths = np.clip(stops - starts, 0, None)
+    valid = lengths > 0
+
+    argmins = np.zeros(starts.size, dtype='int64')
+
+    if not np.any(valid):
+        return argmins
+
+    #### gather all segments in one flat vector
+    seg_offsets = np.cumsum(lengths) - lengths
+    seg_id = np.repeat(np.arange(starts.size), lengths)
+    local_pos = np.arange(lengths.sum()) - seg_offsets[seg_id]
+    vals = x[starts[seg_id] + local_pos]
+
+    #### min by segment then first position reaching it
+    seg_min = np.zeros(starts.size, dtype=vals.dtype)
+    seg_min[valid] = np.minimum.reduceat(vals, seg_offsets[valid])
+    is_min, = np.nonzero(vals == seg_min[seg_id])
+    seg_with_min, first_i = np.unique(seg_id[is_min], return_index=True)
+    argmins[seg_with_min] = local_pos[is_min[first_i]]
+
+    return argmins
+
+
+
 #resp = respi_allcond[cond][odor_i]
 def detect_respiration_cycles(resp, srate, baseline_mode='manual', baseline=None, 
                               epsilon_factor1=10, epsilon_factor2=5, inspiration_adjust_on_derivative=False):
@@ -114,26 +147,26 @@ def detect_respiration_cycles(resp, srate, baseline_mode='manual', baseline=None
 
     if inspiration_adjust_on_derivative:
         # lets find local minima on second derivative
-        # this can be slow
+        # all cycles at once with segmented argmin on [i0, i1) windows
         delta_ms = 10.
         delta = int(delta_ms * srate / 1000.)
         derivate1 = np.gradient(resp)
         derivate2 = np.gradient(derivate1)
-        for i in range(ind_exp.size):
-            i0, i1 = ind_insp[i], ind_exp[i]
-            i0 = max(0, i0 - delta)
-            i1 = i0 + np.argmin(resp[i0:i1])
-            d1 = derivate1[i0:i1]
-            i1 = i0 + np.argmin(d1)
-            if (i1 - i0) >2:
-                # find the last crossing zeros in this this short segment
-                d2 = derivate2[i0:i1]
-                i1 = i0 + np.argmin(d2)
-                if (i1 - i0) >2:
-                    d2 = derivate2[i0:i1]
-                    mask = (d2[:-1] >=0) & (d2[1:] < 0)
-                    if np.any(mask):
-                        ind_insp[i] = i0 + np.nonzero(mask)[0][-1]
+
+        i0 = np.maximum(0, ind_insp[:ind_exp.size] - delta)
+        i1 = i0 + segment_argmin(resp, i0, ind_exp)
+        i1 = i0 + segment_argmin(derivate1, i0, i1)
+        refine = (i1 - i0) > 2
+        i1 = np.where(refine, i0 + segment_argmin(derivate2, i0, np.where(refine, i1, i0)), i1)
+        refine &= (i1 - i0) > 2
+
+        # find the last crossing zeros in each short segment, d2[:-1] >= 0 & d2[1:] < 0 in [i0, i1-1)
+        cross = (derivate2[:-1] >= 0) & (derivate2[1:] < 0)
+        last_cross = np.maximum.accumulate(np.where(cross, np.arange(cross.size), -1))
+        last_cross_seg = last_cross[np.clip(i1 - 2, 0, None)]
+        refine &= last_cross_seg >= i0
+
+        ind_insp[:ind_exp.size][refine] = last_cross_seg[refine]
 
     if ind_exp.shape[0] != ind_insp[:-1].shape[0]:
 
@@ -157,6 +190,110 @@ def detect_respiration_cycles(resp, srate, baseline_mode='manual', baseline=None
 
 
 
+#resp_chunks = (respi[i:i+srate*60] for i in range(0, respi.shape[0], srate*60))
+def detect_respiration_cycles_online(resp_chunks, srate, epsilon_factor1=10, epsilon_factor2=5, quantile_decimation=10):
+    """
+    Streaming version of detect_respiration_cycles for long or live recordings.
+    Baseline (mean) and q10 are running estimates (q10 with P² algorithm) so memory stays constant.
+
+    Parameters
+    ----------
+    resp_chunks: iterable of np.array
+        Successive chunks of the preprocessed respiratory signal.
+    srate: float
+        Sampling rate
+    quantile_decimation: int
+        Only one sample every quantile_decimation is fed to the q10 estimator, respi is oversampled.
+    Yields
+    ------
+    cycles: np.array
+        Cycles completed with this chunk. shape=(num_cycle, 3)
+        with [index_inspi, index_expi, index_next_inspi], indices from the start of the recording.
+        Partial cycles are carried to the next chunk.
+    """
+
+    q10_state = p2_quantile_init(0.10)
+    resp_sum, resp_count = 0., 0
+    decim_phase = 0
+    last_sample = None
+
+    insp_candidate, insp_confirmed, exp_confirmed = None, None, None
+
+    for chunk in resp_chunks:
+
+        chunk = np.asarray(chunk, dtype='float64').reshape(-1)
+
+        if chunk.size == 0:
+            continue
+
+        #### update running baseline
+        resp_sum += chunk.sum()
+        resp_count += chunk.size
+        baseline = resp_sum / resp_count
+
+        for x in chunk[decim_phase::quantile_decimation]:
+            p2_quantile_update(q10_state, x)
+        decim_phase = (decim_phase - chunk.size) % quantile_decimation
+        q10 = p2_quantile_value(q10_state)
+
+        epsilon = (baseline - q10) / 100.
+        baseline_dw = baseline - epsilon * epsilon_factor1
+        baseline_insp = baseline - epsilon * epsilon_factor2
+
+        #### crossings, with last sample of previous chunk to catch crossings on the edge
+        chunk_start = resp_count - chunk.size
+
+        if last_sample is None:
+            resp, offset = chunk, chunk_start
+        else:
+            resp, offset = np.concatenate(([last_sample], chunk)), chunk_start - 1
+
+        last_sample = chunk[-1]
+
+        resp0 = resp[:-1]
+        resp1 = resp[1:]
+
+        ind_dw, = np.nonzero((resp0 >= baseline_dw) & (resp1 < baseline_dw))
+        ind_insp, = np.nonzero((resp0 >= baseline_insp) & (resp1 < baseline_insp))
+        ind_exp, = np.nonzero((resp0 < baseline) & (resp1 >= baseline))
+
+        #### same logic as detect_respiration_cycles on the few crossing events
+        # 0 : dw, 1 : insp, 2 : exp, dw first on same index as in searchsorted side='left'
+        event_inds = np.concatenate((ind_dw, ind_insp, ind_exp)) + offset
+        event_types = np.concatenate((np.zeros(ind_dw.size), np.ones(ind_insp.size), np.ones(ind_exp.size)*2)).astype('int')
+        order = np.lexsort((event_types, event_inds))
+
+        cycles = []
+
+        for event_ind, event_type in zip(event_inds[order], event_types[order]):
+
+            if event_type == 1:
+                insp_candidate = event_ind
+
+            elif event_type == 0:
+
+                if insp_candidate is None or insp_candidate == insp_confirmed:
+                    continue
+
+                # this remove inspi assigned to the same expi
+                if insp_confirmed is not None and exp_confirmed is None:
+                    continue
+
+                if insp_confirmed is not None:
+                    cycles.append([insp_confirmed, exp_confirmed, insp_candidate])
+
+                insp_confirmed, exp_confirmed = insp_candidate, None
+
+            elif event_type == 2:
+
+                if insp_confirmed is not None and exp_confirmed is None:
+                    exp_confirmed = event_ind
+
+        yield np.array(cycles, dtype='int64').reshape(-1, 3)
+
+
+
+
 
 
 
@@ -191,14 +328,14 @@ def exclude_bad_cycles(respi, cycles_init, srate, exclusion_metrics='med', metri
         plt.show()
 
     if exclusion_metrics == 'med':
-        med, mad = physio.compute_median_mad(_diff)
+        med, mad = median_mad(_diff, constant=1/0.6744897501960817)
         metric_center, metric_dispersion = med, mad
 
     if exclusion_metrics == 'mean':
         metric_center, metric_dispersion = _diff.mean(), _diff.std()
 
     if exclusion_metrics == 'mod':
-        med, mad = physio.compute_median_mad(_diff)
+        med, mad = median_mad(_diff, constant=1/0.6744897501960817)
         mod = physio.get_empirical_mode(_diff)
         metric_center, metric_dispersion = mod, med
 
@@ -272,14 +409,14 @@ def exclude_bad_cycles(respi, cycles_init, srate, exclusion_metrics='med', metri
 
     #### exclude regarding metric
     if exclusion_metrics == 'med':
-        med, mad = physio.compute_median_mad(cycle_metrics_cleaned)
+        med, mad = median_mad(cycle_metrics_cleaned, constant=1/0.6744897501960817)
         metric_center, metric_dispersion = med, mad
 
     if exclusion_metrics == 'mean':
         metric_center, metric_dispersion = cycle_metrics_cleaned.mean(), cycle_metrics_cleaned.std()
 
     if exclusion_metrics == 'mod':
-        med, mad = physio.compute_median_mad(cycle_metrics_cleaned)
+        med, mad = median_mad(cycle_metrics_cleaned, constant=1/0.6744897501960817)
         mod = physio.get_empirical_mode(cycle_metrics_cleaned)
         metric_center, metric_dispersion = mod, med
 